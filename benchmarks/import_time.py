@@ -0,0 +1,79 @@
+"""
+Benchmark the import time of the src package.
+Each module is imported in a fresh interpreter, so the numbers reflect what a CLI invocation
+or a new worker process pays before doing any work.
+
+Usage:
+    python benchmarks/import_time.py [repeats]
+"""
+import os.path
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "src.utils",
+    "src.spacetime.spacetime_handlers",
+    "src.spacetime.spacetime_analytics",
+    "src.waze",
+    "src.nws",
+]
+
+# Optional dependencies that should only load on first use
+HEAVY = [
+    "googleapiclient",
+    "google_auth_oauthlib",
+    "matplotlib",
+    "sklearn",
+    "pysal",
+    "requests",
+]
+
+PROBE = """
+import sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(t)
+print(",".join(m for m in {heavy} if m in sys.modules))
+"""
+
+
+def time_import(module):
+    """Import a module in a fresh interpreter.
+    Returns the import time in seconds and the heavy modules that were loaded,
+    or None and the error if the import failed"""
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if out.returncode != 0:
+        return None, out.stderr.strip().splitlines()[-1]
+    seconds, loaded = out.stdout.splitlines()[-2:]
+    return float(seconds), loaded
+
+
+def main(repeats=3):
+    print("{:<40}{:>12}{:>12}  {}".format("module", "best (ms)", "wall (ms)", "heavy modules loaded"))
+    for module in MODULES:
+        best = None
+        wall = None
+        loaded = ""
+        for _ in range(repeats):
+            t = time.perf_counter()
+            seconds, loaded = time_import(module)
+            elapsed = time.perf_counter() - t
+            if seconds is None:
+                break
+            best = seconds if best is None else min(best, seconds)
+            wall = elapsed if wall is None else min(wall, elapsed)
+        if best is None:
+            print("{:<40}{:>12}{:>12}  {}".format(module, "-", "-", "import failed: " + loaded))
+        else:
+            print("{:<40}{:>12.1f}{:>12.1f}  {}".format(module, best * 1000, wall * 1000, loaded or "none"))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
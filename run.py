@@ -1,46 +1,84 @@
 from datetime import datetime
-from src.waze import WazeHandler
-from src.nws import *
-from src.configuration import Extent
-from src.utils import *
-from src.spacetime.spacetime_analytics import SpaceTimePointStatistics, get_equidistant_dataframe
+import copy
+import os.path
+import math
 import numpy as np
+import pandas as pd
+import geopandas as gpd
 import matplotlib.pyplot as plt
-import math
-
-
-def prep(extent, waze_storm):
+from src.waze import WazeHandler, WazeColumnStore
+from src.nws import LocalStormReportHandler, get_fetched_paths, iterative_fetch
+from src.configuration import Extent, config
+from src.session import AnalysisSession
+from src.export import ReportWriter, virtual_reports
+from src.spacetime.spacetime_handlers import AbstractGeoHandler
+from src.spacetime.spacetime_analytics import SpaceTimePointStatistics, get_equidistant_dataframe, \
+    st_dbscan_parameters, temporal_neighbour_counts
+from src.spacetime.spacetime_kde import kde_grid
+from src.spacetime.spacetime_calibration import CalibrationCache
+
+
+def prep(extent, waze_storm, waze_store=None):
     """Prepare the workspace by loading Waze, LSRs, and Warnings and cutting them to the appropriate extent"""
-    waze = WazeHandler(waze_storm)
+    waze = WazeHandler(waze_storm, store=waze_store)
     waze.prep_data()
-    waze.clip_temporal(extent.temporal[0], extent.temporal[1])
-    waze.clip_by_shape(extent.spatial.gdf)
+    extent.apply(waze)
     #LSRS
     storm_reports = iterative_fetch(extent, LocalStormReportHandler)
     storm_reports.prep_data()
     storm_reports.gdf = storm_reports.gdf.reset_index()
-    storm_reports.clip_by_shape(extent.spatial.gdf)
+    extent.apply(storm_reports, temporal=False)
     #SWs
     # storm_warnings = iterative_fetch(extent, StormWarningHandler)
     # storm_warnings.prep_data()
     # storm_warnings.gdf = storm_reports.gdf.reset_index()
-    # storm_warnings.clip_by_shape(extent.spatial.gdf)
+    # extent.apply(storm_warnings, temporal=False)
     return waze, storm_reports
 
 
+harvey_extent_file = "/Users/christopherjlowrie/Repos/FlashFloodResponse/data/harvey_misc/harvey_extent.shp"
 harvey_extent = Extent(
     temporal=(datetime(2017, 8, 23), datetime(2017, 9, 15)),
     spatial=AbstractGeoHandler(
-        gdf=gpd.read_file("/Users/christopherjlowrie/Repos/FlashFloodResponse/data/harvey_misc/harvey_extent.shp")
+        gdf=gpd.read_file(harvey_extent_file)
     )
 )
 
-w, lsrs = prep(harvey_extent, "Harvey")
+
+# Waze synced incrementally with sync_waze_to_local is read from the column store,
+# otherwise from the waze_Harvey.txt export
+waze_store = WazeColumnStore(config.waze)
+if waze_store.get_state("Harvey") is not None:
+    waze_input = waze_store.get_state_path("Harvey")
+else:
+    waze_store = None
+    waze_input = os.path.join(config.waze, "waze_Harvey.txt")
+
+
+def build_session():
+    """Prep the Harvey handlers into a session, rebuilt only when the Waze data, LSRs or the extent change"""
+    waze, storm_reports = prep(harvey_extent, "Harvey", waze_store=waze_store)
+    # The IEM files iterative_fetch read; add get_fetched_paths(harvey_extent, StormWarningHandler)
+    # once prep cuts warnings too
+    inputs = [waze_input, harvey_extent_file] + get_fetched_paths(harvey_extent, LocalStormReportHandler)
+    session = AnalysisSession("Harvey", extent=harvey_extent, inputs=inputs)
+    session.add_handler("waze", waze)
+    session.add_handler("lsrs", storm_reports)
+    # The Waze by LSR distance (metres) and time (seconds, Waze - LSR) matrices the calibration filters
+    session.set_artifact("d0", storm_reports.bivariate_spatial_distance_matrix(waze))
+    session.set_artifact("t0", storm_reports.bivariate_temporal_distance_matrix(waze)
+                         .applymap(lambda x: x.total_seconds()))
+    return session
+
+
+session_dir = os.path.join(config.tmp, "session_Harvey")
+session = AnalysisSession.load_or_build(session_dir, build_session, extent=harvey_extent)
+w, lsrs = session["waze"], session["lsrs"]
 
 print(lsrs)
-d0 = lsrs.bivariate_spatial_distance_matrix(w)
-t0 = lsrs.bivariate_temporal_distance_matrix(w)
-t0 = t0.applymap(lambda x: x.total_seconds())
+d0, t0 = session.get_artifact("d0"), session.get_artifact("t0")
+# Filtered matrices and rankings are shared by every (n, p, time_window, temporal_filter) below
+calibration = CalibrationCache(d0, t0)
 
 # Steps:
 # n = number of relationships to find
@@ -52,8 +90,7 @@ time_window = 30*60
 
 # 6 hours previously, to 1 hours after
 temporal_filter = (-6*60*60, 1*60*60)
-t = t0[t0 > temporal_filter[0]][t0 < temporal_filter[1]]
-d = d0[t0 > temporal_filter[0]][t0 < temporal_filter[1]]
+d, t = calibration.get_filtered(temporal_filter)
 
 
 def plot_histogram():
@@ -66,24 +103,17 @@ def plot_histogram():
 
 
 def calculate_spatial_kde(n, temporal_filter=temporal_filter):
-    # Filter distance matrices to only the points that fit the temporal filter
-    d = d0[t0 > temporal_filter[0]][t0 < temporal_filter[1]]
-    # Find the threshold radius to contain n points
-    dist = SpaceTimePointStatistics.distance_to_n_points_by_observation(d, n)
+    # Find the threshold radius to contain n points, among the points that fit the temporal filter
+    dist = calibration.distance_to_n_points(n, temporal_filter)
     dist.hist(bins=30)
     plt.title("Histogram of Spatial Radii for inclusion of {} points".format(str(n)))
     plt.show()
 
-    from sklearn.neighbors import KernelDensity
-    x_d = np.linspace(0, 250000, 50000)
-    # instantiate and fit the KDE model
-    kde = KernelDensity(bandwidth=10000, kernel='gaussian')
-    kde.fit(dist[:, None])
-
-    # score_samples returns the log of the probability density
-    logprob = kde.score_samples(x_d[:, None])
+    # Binned FFT KDE, evaluated on 50,000 points between 0 and 250km
+    (x_d,), density = kde_grid(dist.dropna().to_numpy(), bandwidth=10000,
+                               grid_min=0, grid_max=250000, grid_size=50000)
 
-    plt.fill_between(x_d, np.exp(logprob), alpha=0.5)
+    plt.fill_between(x_d, density, alpha=0.5)
     plt.plot(dist, np.full_like(dist, -0.000001), '|k', markeredgewidth=1)
     plt.ylim(-0.000002, 0.000015)
     plt.title("Kernel Density Estimate of Spatial Radii for inclusion of {} points".format(str(n)))
@@ -92,14 +122,9 @@ def calculate_spatial_kde(n, temporal_filter=temporal_filter):
 
 def calculate_temporal_kde(waze_times, temporal_filter=30*60):
     # Filter distance matrices to only the points that fit the temporal filter
-    from sklearn.neighbors import KernelDensity
-    x_d = np.linspace(0, 6*60*60, 60*60)
-    # instantiate and fit the KDE model
-    kde = KernelDensity(bandwidth=temporal_filter, kernel='tophat')
-    kde.fit(waze_times[:, None])
-    # score_samples returns the log of the probability density
-    logprob = kde.score_samples(x_d[:, None])
-    plt.fill_between(x_d, np.exp(logprob), alpha=0.5)
+    (x_d,), density = kde_grid(np.asarray(waze_times, dtype=float), bandwidth=temporal_filter, kernel='tophat',
+                               grid_min=0, grid_max=6*60*60, grid_size=60*60)
+    plt.fill_between(x_d, density, alpha=0.5)
     plt.plot(waze_times, np.full_like(waze_times, -0.000001), '|k', markeredgewidth=1)
     plt.axvline(1800)
     plt.ylim(-0.000002, 0.00025)
@@ -131,10 +156,9 @@ def plot_waze_timecube(w0, threshold_by_point):
 
 def main(n, p, time_window=30*60, temporal_filter=(-6*60*60, 1*60*60)):
     # Filter distance matrices to only the points that fit the temporal filter
-    t = t0[t0 > temporal_filter[0]][t0 < temporal_filter[1]]
-    d = d0[t0 > temporal_filter[0]][t0 < temporal_filter[1]]
+    d, t = calibration.get_filtered(temporal_filter)
     # Find the threshold radius to contain n points
-    dist = SpaceTimePointStatistics.distance_to_n_points_by_observation(d, n)
+    dist = calibration.distance_to_n_points(n, temporal_filter)
     print(sorted(dist))
     print(len(dist))
     spatial_distance_threshold = dist.quantile(p)
@@ -148,23 +172,13 @@ def main(n, p, time_window=30*60, temporal_filter=(-6*60*60, 1*60*60)):
         thresh = threshold_by_point[i]
         # print(thresh)
         filtered_distance_matrix[i] = d[i][d[i] < thresh]
-    # Plotting SpaceTime Cubes
-    temporal_distance_buffer = []
+    # For each LSR, count the Waze reports within time_window of each report inside its radius,
+    # in one sorted sweep over all LSRs, grouped by LSR
     print(n)
-    for i in filtered_distance_matrix:
-        print(i)
-    for i in filtered_distance_matrix:
-        import copy
-        index = filtered_distance_matrix[i][filtered_distance_matrix[i].apply(lambda x: not np.isnan(x))].index
-        w0 = copy.copy(w)
-        w0.gdf = w0.gdf.loc[index]
-        w0.gdf = get_equidistant_dataframe(w0.gdf)
-        waze_time_matrix = w0.bivariate_temporal_distance_matrix(w0).applymap(lambda t: abs(t.total_seconds()))
-        print(waze_time_matrix)
-        for waze_report in waze_time_matrix:
-            # calculate_temporal_kde(waze_time_matrix[waze_report], time_window)
-            temporal_distance_buffer.append(len(waze_time_matrix[waze_report][waze_time_matrix[waze_report] < time_window]))
-    temporal_distance_buffer = pd.Series(temporal_distance_buffer)
+    lsr_position, waze_position = np.nonzero(filtered_distance_matrix.notna().to_numpy().T)
+    waze_times = w.get_space_time_arrays()[1]
+    temporal_distance_buffer = pd.Series(temporal_neighbour_counts(waze_times[waze_position], time_window,
+                                                                   groups=lsr_position))
     plt.hist(temporal_distance_buffer, bins=[i-0.5 for i in range(n+1)])
     plt.title("Histogram of Temporal Clustering; N={}".format(n))
     plt.xticks([i for i in range(n+1)])
@@ -175,30 +189,40 @@ def main(n, p, time_window=30*60, temporal_filter=(-6*60*60, 1*60*60)):
 
 
 
-x = dict()
-for n in range(10, 31, 10):
-    for p in (0.05,):
-        try:
-            x[(n, p)] = main(n, p)
-        except:
-            pass
+# The calibrated thresholds are saved with the session, and the grid search only re-runs
+# when the session is rebuilt or the grid changes
+grid = {"n": list(range(10, 31, 10)), "p": [0.05], "time_window": time_window,
+        "temporal_filter": list(temporal_filter)}
+if session.get_artifact("threshold_grid") == grid:
+    x = {(n, p): (s, t) for n, p, s, t in session.get_artifact("thresholds")}
+else:
+    x = dict()
+    for n in grid["n"]:
+        for p in grid["p"]:
+            try:
+                x[(n, p)] = main(n, p, grid["time_window"], tuple(grid["temporal_filter"]))
+            except:
+                pass
+    session.set_artifact("threshold_grid", grid)
+    session.set_artifact("thresholds", [[n, p, s, t] for (n, p), (s, t) in x.items()])
+    session.save(session_dir)
 
 
 print("N, p, S, T")
 for k,v in x.items():
     print(k[0], k[1], v[0], v[1])
+print("Calibration cache:", calibration.cache.stats())
 
 
 
-waze_time_matrix = w.bivariate_temporal_distance_matrix(w).applymap(lambda t: abs(t.total_seconds()))
-waze_space_matrix = w.bivariate_spatial_distance_matrix(w)
-
 def validate_waze_reports(spatial_distance_threshold, temporal_distance_threshold, n):
-    wtm2 = copy.copy(waze_time_matrix)
-    wtm2 = wtm2[waze_space_matrix < spatial_distance_threshold]
-    waze_time_densities = wtm2[wtm2 < time_window].count()
-    validated_waze_reports = waze_time_densities[waze_time_densities > temporal_distance_threshold]
-    print(len(validated_waze_reports))
+    # Validated reports are the core points of a space-time DBSCAN with the calibrated thresholds
+    parameters = st_dbscan_parameters((spatial_distance_threshold, temporal_distance_threshold),
+                                      time_window=time_window)
+    clusters = calibration.memoize(("st_dbscan",) + tuple(sorted(parameters.items())),
+                                   lambda: w.st_dbscan(**parameters))
+    validated_waze_reports = clusters[clusters.is_core]
+    print(len(validated_waze_reports), "validated reports in", validated_waze_reports.cluster.nunique(), "clusters")
     w0 = copy.copy(w)
     w0.gdf = w0.gdf.loc[validated_waze_reports.index]
     x1 = w0.spacetime_cube()
@@ -242,40 +266,40 @@ for i in y6.index:
 #
 #
 #
-lt = lsrs.bivariate_temporal_distance_matrix(lsrs)
-lt = lt.applymap(lambda x: x.total_seconds())
-ld = lsrs.bivariate_spatial_distance_matrix(lsrs)
-lt = lt[lt > temporal_filter[0]][lt < temporal_filter[1]]
-ld = ld[lt > temporal_filter[0]][lt < temporal_filter[1]]
-limit_to_be_new = ld[ld!= 0].min().quantile(0.5)
+# A Waze report is new if it is further from any LSR than LSRs typically are from each other.
+# Among LSRs the filter applies to (other LSR time - LSR time), so it is flipped, and other LSRs
+# at the same location are skipped
+lsr_nearest = lsrs.nearest_reference_event(lsrs, temporal_filter=(-temporal_filter[1], -temporal_filter[0]),
+                                           exclude_self=True, exclude_coincident=True)
+limit_to_be_new = lsr_nearest.nearest_distance.quantile(0.5)
+waze_nearest = w.nearest_reference_event(lsrs, temporal_filter=temporal_filter)
+min_d = waze_nearest.nearest_distance.fillna(1000000).rename("min_d")
 #
 
 a = []
 for i in range(1, 15):
-    w0 = copy.copy(w)
-    w0.gdf = w0.gdf.loc[y3[y3 >= i].index]
-    min_d = d.transpose().min().rename("min_d")
-    min_d[min_d.isnull()] = 1000000
-    w0.gdf = w0.gdf.join(min_d)
-    w0.gdf = w0.gdf[w0.gdf.min_d > limit_to_be_new]
-    a.append(w0.gdf.shape[0])
+    supported = y3[y3 >= i].index
+    a.append(int((min_d.loc[supported] > limit_to_be_new).sum()))
 
 
 for i in a[::-1]:
     print(i)
 
+# Export the virtual reports, with their supporting N-configurations and nearest LSR, duplicates collapsed
+with ReportWriter(os.path.join(config.tmp, "virtual_reports_Harvey.csv")) as writer:
+    writer.write_all(virtual_reports(w, y3, waze_nearest.nearest_distance, spatial_distance_threshold, time_window))
+
 
 for i in ("filtered",):
     for j in ("3D",):
         for k in (2, 3):
             w0 = copy.copy(w)
             w0.gdf = w0.gdf.loc[y3[y3 == k].index]
-            min_d = d.transpose().min().rename("min_d")
-            min_d[min_d.isnull()] = 1000000
             w0.gdf = w0.gdf.join(min_d)
             if i == "filtered":
                 w0.gdf = w0.gdf[w0.gdf.min_d > limit_to_be_new]
-            print(w0.gdf.shape[0])
+            duplicates = w0.cluster_duplicates(spatial_distance_threshold, time_window)
+            print(w0.gdf.shape[0], "reports in", duplicates.cluster.nunique(), "clusters")
             x = w0.spacetime_cube()
             lsrs.add_self_to_spacetime_cube(x)
             x.set_zticklabels([datetime.fromtimestamp(int(i)).strftime(format="%m/%d - %H:%M") for i in x.get_zticks()],
@@ -301,12 +325,6 @@ for i in ("filtered",):
 # plt.title("Histogram of Spatial Relationship\nBetween Waze and LSRs")
 # plt.show()
 
-lt = lsrs.bivariate_temporal_distance_matrix(lsrs)
-lt = lt.applymap(lambda x: x.total_seconds())
-ld = lsrs.bivariate_spatial_distance_matrix(lsrs)
-t = lt[lt > temporal_filter[0]][lt < temporal_filter[1]]
-d = ld[lt > temporal_filter[0]][lt < temporal_filter[1]]
-limit_to_be_new = d[d!= 0].min().quantile(0.5)
 
 
 x1 = w.spacetime_cube()
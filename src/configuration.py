@@ -0,0 +1,121 @@
+import os.path
+import uuid
+import numpy as np
+import pandas as pd
+
+"""
+Local configuration, and the space-time extent of a storm.
+Data directories default to data/ at the root of the repository, and can be moved with environment variables:
+FFR_DATA_DIR for all of them, or FFR_WAZE_DIR, FFR_LSR_DIR, FFR_SW_DIR and FFR_TMP_DIR one by one.
+They are created by whatever writes to them first, so importing the package doesn't touch the file system.
+"""
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Config:
+    """Paths to the local data stores"""
+
+    def __init__(self):
+        data_dir = os.environ.get("FFR_DATA_DIR", os.path.join(ROOT_DIR, "data"))
+        self.waze = os.environ.get("FFR_WAZE_DIR", os.path.join(data_dir, "waze"))
+        self.lsr = os.environ.get("FFR_LSR_DIR", os.path.join(data_dir, "lsr"))
+        self.sw = os.environ.get("FFR_SW_DIR", os.path.join(data_dir, "sw"))
+        self.tmp = os.environ.get("FFR_TMP_DIR", os.path.join(data_dir, "tmp"))
+
+
+config = Config()
+
+
+class Extent:
+    """
+    The temporal extent (t0, t1) and spatial extent (an AbstractGeoHandler of polygons) of a storm.
+    The polygons are merged and prepared once, and the temporal bounds converted to datetime64,
+    so apply() clips any point or duration handler in one vectorized pass.
+    Masks are memoized on the handler, so they are reused until the handler's gdf changes.
+    The handler and the extent should be in the same CRS.
+    """
+
+    def __init__(self, temporal, spatial):
+        self.temporal = temporal
+        self.spatial = spatial
+        self.t0, self.t1 = (np.datetime64(pd.Timestamp(t).to_datetime64()) for t in temporal)
+        self.polygon = spatial.gdf.geometry.unary_union
+        self.bbox = self.polygon.bounds
+        # Identifies this extent in handler caches, which may be saved and loaded in other processes
+        self._token = uuid.uuid4().hex
+        self._prepared = None
+
+    def __getstate__(self):
+        """Prepared geometries can't be pickled, and are prepared again on first use"""
+        state = dict(self.__dict__)
+        state["_prepared"] = None
+        return state
+
+    @property
+    def prepared(self):
+        if self._prepared is None:
+            from shapely.prepared import prep
+            self._prepared = prep(self.polygon)
+        return self._prepared
+
+    def get_temporal_mask(self, handler):
+        """Points strictly within (t0, t1), or durations overlapping it, as clip_temporal"""
+        if hasattr(handler, "t_start_field"):
+            start = pd.to_datetime(handler.gdf[handler.t_start_field]).to_numpy()
+            end = pd.to_datetime(handler.gdf[handler.t_end_field]).to_numpy()
+            return (start < self.t1) & (end > self.t0)
+        t = pd.to_datetime(handler.gdf[handler.t_field]).to_numpy()
+        return (t > self.t0) & (t < self.t1)
+
+    def get_spatial_mask(self, handler, rows=None):
+        """
+        Features intersecting the spatial extent, tested first against its bbox from the handler's cached bounds,
+        and then against the prepared polygon.  rows limits the exact tests to a boolean selection.
+        """
+        from src.spacetime.spacetime_handlers import has_vectorized_shapely, points_intersect
+        minx, miny, maxx, maxy = self.bbox
+        bounds = handler.get_feature_bounds()
+        mask = (bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny)
+        if rows is not None:
+            mask &= rows
+        candidates = np.flatnonzero(mask)
+        geometry = handler.gdf.geometry
+        if (geometry.geom_type == "Point").all():
+            # Point bounds are their coordinates
+            mask[candidates] = points_intersect(self.prepared, bounds[candidates, 0], bounds[candidates, 1])
+        elif has_vectorized_shapely():
+            import shapely
+            shapely.prepare(self.polygon)
+            mask[candidates] = shapely.intersects(self.polygon, geometry.to_numpy()[candidates])
+        else:
+            mask[candidates] = [self.prepared.intersects(g) for g in geometry.iloc[candidates]]
+        return mask
+
+    def get_mask_key(self, temporal=True, spatial=True):
+        return "extent_mask_{}_{:d}{:d}".format(self._token, temporal, spatial)
+
+    def get_mask(self, handler, temporal=True, spatial=True):
+        """The rows of a handler within the extent, memoized until its gdf changes"""
+        def compute():
+            mask = self.get_temporal_mask(handler) if temporal else np.ones(len(handler.gdf), dtype=bool)
+            if spatial:
+                mask = self.get_spatial_mask(handler, rows=mask)
+            return mask
+        return handler.cached(self.get_mask_key(temporal, spatial), compute)
+
+    def apply(self, handler, temporal=True, spatial=True):
+        """
+        Clip a handler to the extent, in place.
+        Replaces clip_temporal followed by clip_by_shape, except that polygons intersecting the extent
+        are kept whole, rather than cut to it.
+        A handler already within the extent is left as it is, with its caches.  Otherwise the clipped gdf
+        is known to be within the extent, so its masks are stored rather than computed again.
+        """
+        mask = self.get_mask(handler, temporal=temporal, spatial=spatial)
+        if mask.all():
+            return
+        handler.gdf = handler.gdf[mask]
+        for t, s in ((temporal, spatial), (temporal, False), (False, spatial)):
+            if t or s:
+                handler.set_cached(self.get_mask_key(t, s), np.ones(len(handler.gdf), dtype=bool))
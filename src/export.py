@@ -0,0 +1,178 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.spacetime.spacetime_analytics import cluster_duplicate_points
+
+"""
+Machine-readable output for validated Waze reports.
+ReportWriter streams GeoDataFrames to CSV, newline-delimited GeoJSON (.geojsonl, one feature per line),
+GeoJSON text sequences (.geojsons, RFC 8142: each feature prefixed by a record separator) or GeoParquet,
+a chunk of rows at a time, so memory is bounded by the chunk size rather than the output.
+All formats can be appended to, for incremental runs.
+pyarrow is only needed for GeoParquet, and is imported on first use.
+"""
+
+FORMATS = {".csv": "csv", ".geojsonl": "geojsonl", ".geojsons": "geojsonseq", ".geojsonseq": "geojsonseq",
+           ".parquet": "parquet"}
+
+# RFC 8142 record separator
+RS = "\x1e"
+
+
+def get_format(path):
+    """The output format for a path, by its extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError("Unknown export format {}; use one of {}".format(ext, sorted(FORMATS)))
+    return FORMATS[ext]
+
+
+def iter_chunks(frame, chunk_size):
+    """Split a frame into consecutive chunks of at most chunk_size rows"""
+    for start in range(0, len(frame), chunk_size):
+        yield frame.iloc[start:start + chunk_size]
+
+
+def to_json_value(value):
+    """Convert a pandas or numpy scalar to a JSON value"""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+class ReportWriter:
+    """
+    Streaming writer of GeoDataFrames, with the format picked from the path's extension.
+    GeoParquet output is a directory of part files, one per chunk.  Rows are written in EPSG:4326.
+    Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, path, append=False, chunk_size=10000):
+        self.path = path
+        self.format = get_format(path)
+        self.chunk_size = chunk_size
+        self.columns = None
+        self._file = None
+        self._parts = 0
+        if self.format == "parquet":
+            if not append and os.path.exists(path):
+                for i in os.listdir(path):
+                    if i.startswith("part-"):
+                        os.remove(os.path.join(path, i))
+            os.makedirs(path, exist_ok=True)
+            self._parts = len([i for i in os.listdir(path) if i.startswith("part-")])
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            exists = append and os.path.exists(path) and os.path.getsize(path) > 0
+            if exists and self.format == "csv":
+                # Keep the columns of the existing file, so appended rows line up with its header
+                self.columns = list(pd.read_csv(path, nrows=0).columns)
+            self._file = open(path, "a" if exists else "w", newline="")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, gdf):
+        """Write a GeoDataFrame, chunk by chunk; each chunk is reprojected on its own"""
+        for chunk in iter_chunks(gdf, self.chunk_size):
+            if chunk.crs is not None:
+                chunk = chunk.to_crs(epsg=4326)
+            getattr(self, "write_" + self.format)(chunk)
+
+    def write_all(self, gdfs):
+        """Write an iterable of GeoDataFrames, e.g. one per partition, holding one at a time"""
+        for gdf in gdfs:
+            self.write(gdf)
+
+    def write_csv(self, chunk):
+        """Points are written as lon, lat columns, other geometries as WKT"""
+        df = pd.DataFrame(chunk.drop(columns=chunk.geometry.name))
+        if (chunk.geom_type == "Point").all():
+            df["lon"] = chunk.geometry.x
+            df["lat"] = chunk.geometry.y
+        else:
+            df["wkt"] = chunk.geometry.to_wkt() if hasattr(chunk.geometry, "to_wkt") \
+                else [g.wkt for g in chunk.geometry]
+        if self.columns is None:
+            self.columns = list(df.columns)
+            df.to_csv(self._file, index=False)
+        else:
+            df.reindex(columns=self.columns).to_csv(self._file, index=False, header=False)
+
+    def write_features(self, chunk, prefix=""):
+        """Write one GeoJSON feature per line, each after prefix"""
+        from shapely.geometry import mapping
+        properties = pd.DataFrame(chunk.drop(columns=chunk.geometry.name))
+        names = list(properties.columns)
+        lines = []
+        for values, geometry in zip(properties.itertuples(index=False, name=None), chunk.geometry):
+            lines.append(prefix + json.dumps({
+                "type": "Feature",
+                "geometry": None if geometry is None else mapping(geometry),
+                "properties": {k: to_json_value(v) for k, v in zip(names, values)}
+            }) + "\n")
+        self._file.write("".join(lines))
+
+    def write_geojsonl(self, chunk):
+        self.write_features(chunk)
+
+    def write_geojsonseq(self, chunk):
+        self.write_features(chunk, prefix=RS)
+
+    def write_parquet(self, chunk):
+        """Write a chunk as a GeoParquet part file, with WKB geometries"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        geometry = chunk.geometry
+        table = pa.Table.from_pandas(pd.DataFrame(chunk.drop(columns=geometry.name)), preserve_index=False)
+        table = table.append_column(geometry.name, pa.array([None if g is None else g.wkb for g in geometry],
+                                                            type=pa.binary()))
+        column = {"encoding": "WKB", "geometry_types": sorted(set(geometry.geom_type.dropna()))}
+        # A missing crs means longitude, latitude (OGC:CRS84), which is what is written; null means unknown
+        if chunk.crs is None:
+            column["crs"] = None
+        geo = {"version": "1.0.0", "primary_column": geometry.name, "columns": {geometry.name: column}}
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {}, geo=json.dumps(geo)))
+        pq.write_table(table, os.path.join(self.path, "part-{:05d}.parquet".format(self._parts)))
+        self._parts += 1
+
+
+def virtual_reports(handler, support, nearest_distance, spatial_distance, time_window, chunk_size=10000):
+    """
+    Gather the validated Waze reports of run.py for export, as GeoDataFrames of at most chunk_size reports,
+    for ReportWriter.write_all.
+    support counts, per report index, the N-configurations that validated it, and nearest_distance is the
+    distance (metres) to the nearest LSR.  Reports are clustered as by cluster_duplicates, from the handler's
+    cached space-time arrays, and only each cluster's representative is kept, with the number of reports
+    it stands for as duplicates.  Only the clustering covers every report; rows are gathered chunk by chunk.
+    """
+    positions = handler.gdf.index.get_indexer(support.index)
+    xy, t = handler.get_space_time_arrays()
+    labels, is_representative = cluster_duplicate_points(xy[positions], t[positions], spatial_distance, time_window)
+    sizes = np.bincount(labels)
+    nearest = nearest_distance.reindex(support.index).to_numpy()
+    representatives = np.flatnonzero(is_representative)
+    for start in range(0, len(representatives), chunk_size):
+        rows = representatives[start:start + chunk_size]
+        gdf = handler.gdf.iloc[positions[rows]].assign(support=support.to_numpy()[rows],
+                                                       nearest_lsr_distance=nearest[rows],
+                                                       cluster=labels[rows],
+                                                       duplicates=sizes[labels[rows]])
+        yield gpd.GeoDataFrame(gdf, crs=handler.gdf.crs)
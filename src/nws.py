@@ -1,9 +1,10 @@
 import os.path
 from datetime import datetime, timedelta
-from src.spacetime.spacetime_handlers import *
-from src.configuration import *
+import pandas as pd
+from src.spacetime.spacetime_handlers import DataManager, AbstractTimePointEvent, AbstractTimeDurationEvent, \
+    PolygonIndex
+from src.configuration import config
 from src.spacetime.spacetime_analytics import SpaceTimePointStatistics
-from src.utils import *
 
 
 class IowaEnvironmentalMesonet:
@@ -42,18 +43,21 @@ class IowaEnvironmentalMesonet:
         return datetime.strptime(x, '%Y-%m-%dT%H:%M:%S')
 
 
-class StormWarningHandler(IowaEnvironmentalMesonet, DataManager, AbstractTimeDurationEvent):
+class StormWarningHandler(IowaEnvironmentalMesonet, DataManager, AbstractTimeDurationEvent, PolygonIndex):
     """Handler for Storm Warning Polygons"""
 
     t_start_field: str = "issue"
     t_end_field: str = "expire"
+    # Degrees; warning boundaries are only tested exactly within a few hundred metres
+    simplify_tolerance: float = 0.002
     home_dir: str = config.sw
+    endpoint: str = 'sbw.php?sts={t0}&ets={t1}&wfos='
 
     def __init__(self, t0, t1, **kwargs):
         self.t0 = t0
         self.t1 = t1
         # This is unformatted, and gets formatted in IowaEnvironmentalMesonet.construct_url()
-        self.base_url = os.path.join(self.base_url, 'sbw.php?sts={t0}&ets={t1}&wfos=')
+        self.base_url = os.path.join(self.base_url, self.endpoint)
         DataManager.__init__(self, **kwargs)
 
     def prep_data(self):
@@ -72,12 +76,13 @@ class LocalStormReportHandler(IowaEnvironmentalMesonet, DataManager, AbstractTim
 
     t_field: str = "valid"
     home_dir: str = config.lsr
+    endpoint: str = "lsr.php?inc_ap=yes&sts={t0}&ets={t1}&wfos="
 
     def __init__(self, t0, t1, **kwargs):
         self.t0 = t0
         self.t1 = t1
         # This is unformatted, and gets formatted in IowaEnvironmentalMesonet.construct_url()
-        self.base_url = os.path.join(self.base_url, "lsr.php?inc_ap=yes&sts={t0}&ets={t1}&wfos=")
+        self.base_url = os.path.join(self.base_url, self.endpoint)
         DataManager.__init__(self, **kwargs)
 
     def prep_data(self):
@@ -89,21 +94,39 @@ class LocalStormReportHandler(IowaEnvironmentalMesonet, DataManager, AbstractTim
         )
 
 
+def get_fetch_windows(extent, fetch_by=6):
+    """The (t0, t1) windows iterative_fetch requests over the extent's temporal bounds"""
+    min_datetime, max_datetime = extent.temporal
+    current_time = min_datetime
+    while current_time < max_datetime:
+        next_time = current_time + timedelta(hours=fetch_by + 1)
+        yield current_time, next_time
+        current_time = next_time
+
+
+def get_fetched_paths(extent, obj, fetch_by=6):
+    """The local files iterative_fetch reads for an extent, without reading or fetching them"""
+    paths = []
+    for t0, t1 in get_fetch_windows(extent, fetch_by):
+        # Only the times are needed for the path; initializing would read the file
+        window = obj.__new__(obj)
+        window.t0, window.t1 = t0, t1
+        paths.append(window.get_local_path())
+    return paths
+
+
 def iterative_fetch(extent, obj, fetch_by=6):
     """Iteratively fetch when individual API calls would return large results.
     Concatenates the multiple calls into one object to return"""
 
     storm_reports = []
     min_datetime, max_datetime = extent.temporal
-    current_time = min_datetime
     bbox = extent.spatial.get_spatial_extent()
 
-    while current_time < max_datetime:
-        next_time = current_time + timedelta(hours=fetch_by + 1)
+    for current_time, next_time in get_fetch_windows(extent, fetch_by):
         sr = obj(current_time, next_time)
         sr.clip_spatial(bbox)
         storm_reports.append(sr)
-        current_time = next_time
 
     merged_srs = pd.concat([i.gdf for i in storm_reports], sort=False)
     return obj(min_datetime, max_datetime,
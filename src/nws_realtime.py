@@ -0,0 +1,171 @@
+import asyncio
+import functools
+from datetime import datetime, timedelta
+import pandas as pd
+import geopandas as gpd
+from src.nws import IowaEnvironmentalMesonet, LocalStormReportHandler, StormWarningHandler
+
+"""
+Near-real-time ingestion of Local Storm Reports and Storm Warnings from the Iowa Environmental Mesonet,
+for use during an active storm.
+IEMPoller polls each feed's endpoint (lsr.php, sbw.php) for a trailing window on a schedule.
+Requests are conditional on the ETag and Last-Modified of the last response, so an unchanged feed
+costs a 304, and events already seen are dropped by id; ids are forgotten once their events end before
+the trailing window, so they can't be returned again.  New events are prepped like a historical fetch,
+then appended to the feed's handler with append_table, which extends its cached indexes incrementally.
+Requests run in the default executor, so feeds are polled concurrently without blocking the loop.
+Point base_url at a local server to test without the IEM.
+"""
+
+
+class IEMFeed:
+    """
+    One polled IEM endpoint, with the handler its events go to.
+    handler_class is LocalStormReportHandler or StormWarningHandler;
+    lookback is the trailing window requested on each poll, and should span a few polling intervals.
+    id_fields are the properties that identify an event; those present in the response are used.
+    seen maps the id of each event still inside the lookback to the time it ends (its time, for points).
+    """
+
+    def __init__(self, handler_class, lookback=timedelta(hours=6), id_fields=None, bbox=None):
+        self.handler_class = handler_class
+        self.lookback = lookback
+        self.id_fields = id_fields
+        self.bbox = bbox
+        self.handler = None
+        self.etag = None
+        self.last_modified = None
+        self.seen = {}
+        self.end_field = getattr(handler_class, "t_end_field", None) or handler_class.t_field
+
+    def get_url(self, base_url, now):
+        t0 = (now - self.lookback).strftime("%Y%m%d%H%M")
+        t1 = now.strftime("%Y%m%d%H%M")
+        return base_url.rstrip("/") + "/" + self.handler_class.endpoint.format(t0=t0, t1=t1)
+
+    def get_request_headers(self):
+        """Headers making the request conditional on the last response"""
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def get_event_ids(self, gdf):
+        """One string id per event, from the id fields in the response"""
+        fields = [i for i in self.id_fields if i in gdf.columns]
+        if not fields:
+            raise ValueError("None of the id fields {} are in the response".format(self.id_fields))
+        return gdf[fields].astype(str).agg("|".join, axis=1)
+
+    def get_event_ends(self, gdf, now):
+        """When each event ends, as naive UTC; now when it's missing, so the id is still kept a lookback"""
+        if self.end_field not in gdf.columns:
+            return pd.Series(now, index=gdf.index)
+        ends = pd.to_datetime(gdf[self.end_field], errors="coerce", utc=True).dt.tz_localize(None)
+        return ends.fillna(pd.Timestamp(now))
+
+    def forget_seen(self, now):
+        """Drop the ids of events that ended before the trailing window, as no poll can return them again"""
+        t0 = pd.Timestamp(now - self.lookback)
+        self.seen = {k: v for k, v in self.seen.items() if v >= t0}
+
+    def update(self, status_code, headers, features, now):
+        """
+        Take a response, and append its unseen events to the handler.
+        The ETag, Last-Modified and seen ids are only kept once the events are appended, so a response
+        that fails to prep is requested again in full on the next poll.
+        :return: the number of events appended
+        """
+        if status_code == 304:
+            return 0
+        appended = 0
+        if features:
+            gdf = gpd.GeoDataFrame.from_features(features, crs={'init': 'epsg:4326'})
+            ids = self.get_event_ids(gdf)
+            new = ~ids.isin(self.seen).to_numpy() & ~ids.duplicated().to_numpy()
+            if new.any():
+                appended = self.append_events(gdf[new], now)
+            self.seen.update(zip(ids[new], self.get_event_ends(gdf[new], now)))
+        self.forget_seen(now)
+        self.etag = headers.get("ETag", self.etag)
+        self.last_modified = headers.get("Last-Modified", self.last_modified)
+        return appended
+
+    def append_events(self, gdf, now):
+        """Prep new events on their own, as a historical fetch would be, and append them to the handler"""
+        events = self.handler_class(now - self.lookback, now, gdf=gdf)
+        if self.bbox is not None:
+            events.clip_spatial(self.bbox)
+        events.prep_data()
+        if self.handler is None:
+            self.handler = events
+        else:
+            self.handler.append_table(events.gdf)
+        return len(events.gdf)
+
+
+class IEMPoller:
+    """
+    Polls a set of IEMFeeds every interval seconds.
+    now gives the current UTC time, and can be swapped for replays or tests.
+    """
+
+    def __init__(self, feeds, interval=60, base_url=IowaEnvironmentalMesonet.base_url, timeout=30,
+                 now=datetime.utcnow):
+        self.feeds = feeds
+        self.interval = interval
+        self.base_url = base_url
+        self.timeout = timeout
+        self.now = now
+
+    def fetch(self, url, headers):
+        """Blocking GET, run in the executor.  Returns the status, headers and GeoJSON features"""
+        import requests
+        r = requests.get(url, headers=headers, timeout=self.timeout)
+        if r.status_code == 304:
+            return 304, r.headers, None
+        r.raise_for_status()
+        return r.status_code, r.headers, r.json().get("features", [])
+
+    async def poll_feed(self, feed):
+        loop = asyncio.get_event_loop()
+        now = self.now()
+        response = await loop.run_in_executor(
+            None, functools.partial(self.fetch, feed.get_url(self.base_url, now), feed.get_request_headers())
+        )
+        return feed.update(*response, now)
+
+    async def poll_once(self):
+        """Poll every feed concurrently.
+        :return: the number of new events per feed; failed polls give their exception, and are retried next time
+        """
+        return await asyncio.gather(*[self.poll_feed(i) for i in self.feeds], return_exceptions=True)
+
+    async def run(self, iterations=None, callback=None):
+        """
+        Poll until cancelled, or for a number of iterations.
+        callback(poller, new_counts) is called after each poll, e.g. to re-run the validation.
+        """
+        i = 0
+        while iterations is None or i < iterations:
+            counts = await self.poll_once()
+            for feed, count in zip(self.feeds, counts):
+                if isinstance(count, Exception):
+                    print("Polling {} failed: {!r}".format(feed.handler_class.__name__, count))
+            if callback is not None:
+                callback(self, counts)
+            i += 1
+            if iterations is None or i < iterations:
+                await asyncio.sleep(self.interval)
+
+
+def default_feeds(lookback=timedelta(hours=6), bbox=None):
+    """The LSR and Storm Warning feeds"""
+    return [
+        IEMFeed(LocalStormReportHandler, lookback=lookback, bbox=bbox,
+                id_fields=("product_id", "valid", "lat", "lon", "typetext")),
+        IEMFeed(StormWarningHandler, lookback=lookback, bbox=bbox,
+                id_fields=("product_id", "wfo", "phenomena", "significance", "eventid", "issue"))
+    ]
@@ -0,0 +1,429 @@
+import operator
+import os
+import tempfile
+import weakref
+import numpy as np
+import pandas as pd
+from src.spacetime.spacetime_handlers import AbstractGeoHandler
+
+"""
+Functionality for working with rasters, and asking vector-to-raster spatial containment questions,
+e.g. the social vulnerability (SoVI) or precipitation under each warning polygon, ZCTA or Waze report.
+Rasters are read through windows, so only the part under the vectors is loaded,
+and large windows can be read into memory-mapped arrays instead of RAM.
+"""
+
+NO_DATA_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+}
+
+ZONAL_STATISTICS = ("count", "sum", "mean", "std", "min", "max")
+
+# Memory-mapped reads are filled this many cells at a time, bounding the memory they use
+READ_BLOCK_CELLS = 1 << 22
+
+
+def remove_tmp_file(path):
+    """Delete a temporary file, if it can be"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class RasterHandler:
+    """
+    Handler for a single raster band, backed by a file (opened lazily) or an in-memory array.
+    Attributes:
+        - name: a label for the raster
+        - in_file: path of a raster readable by rasterio
+        - numpy_array, meta: an in-memory band, with rasterio metadata (transform, crs, nodata)
+    """
+
+    def __init__(self, name=None, in_file=None, numpy_array=None, meta=None, band=1, memmap_threshold=10**8,
+                 tmp_dir=None):
+        if in_file is None and numpy_array is None:
+            raise ValueError("Either in_file or numpy_array is needed")
+        self.name = name
+        self.in_file = in_file
+        self.band = band
+        self.array = None if numpy_array is None else np.asarray(numpy_array)
+        if self.array is not None and self.array.ndim == 3:
+            self.array = self.array[band - 1]
+        self.meta = dict(meta or {})
+        # Reads of more cells than this go to a memory-mapped file in tmp_dir
+        self.memmap_threshold = memmap_threshold
+        self.tmp_dir = tmp_dir or tempfile.gettempdir()
+        self.no_data_rule = None
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        """The open rasterio dataset, for file backed rasters"""
+        if self._dataset is None and self.in_file is not None:
+            import rasterio
+            self._dataset = rasterio.open(self.in_file)
+            self.meta = dict(self._dataset.meta, **self.meta)
+        return self._dataset
+
+    @property
+    def transform(self):
+        return self.dataset.transform if self.in_file is not None else self.meta["transform"]
+
+    @property
+    def crs(self):
+        return self.dataset.crs if self.in_file is not None else self.meta.get("crs")
+
+    @property
+    def nodata(self):
+        return self.dataset.nodata if self.in_file is not None else self.meta.get("nodata")
+
+    @property
+    def shape(self):
+        return (self.dataset.height, self.dataset.width) if self.in_file is not None else self.array.shape
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+            self._dataset = None
+
+    def set_no_data_mask(self, op, value, replacement=np.nan):
+        """Treat cells where 'cell op value' as no data, e.g. set_no_data_mask("<", -1) for SoVI"""
+        self.no_data_rule = (NO_DATA_OPERATORS[op], value, replacement)
+
+    def get_window(self, bounds):
+        """The window of cells covering bounds (minx, miny, maxx, maxy), clipped to the raster.
+        Returns None if they don't overlap"""
+        from rasterio.windows import Window
+        inverse = ~self.transform
+        cols, rows = inverse * (np.array([bounds[0], bounds[2], bounds[0], bounds[2]]),
+                                np.array([bounds[1], bounds[1], bounds[3], bounds[3]]))
+        height, width = self.shape
+        row0, row1 = max(int(np.floor(rows.min())), 0), min(int(np.ceil(rows.max())), height)
+        col0, col1 = max(int(np.floor(cols.min())), 0), min(int(np.ceil(cols.max())), width)
+        if row0 >= row1 or col0 >= col1:
+            return None
+        return Window(col0, row0, col1 - col0, row1 - row0)
+
+    def read(self, window=None):
+        """
+        Read a window of the band (all of it by default) as float64, with no data as NaN.
+        Windows of more than memmap_threshold cells are read into a memory-mapped temporary file, a block of rows
+        at a time, so the band is never held in RAM; the file is deleted once the array is no longer used.
+        """
+        from rasterio.windows import Window
+        if window is None:
+            window = Window(0, 0, self.shape[1], self.shape[0])
+        shape = (int(window.height), int(window.width))
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        if shape[0] * shape[1] > self.memmap_threshold:
+            from src.utils import get_tmp_path
+            path = get_tmp_path(self.tmp_dir, ".dat")
+            out = np.memmap(path, dtype=np.float64, mode="w+", shape=shape)
+            weakref.finalize(out, remove_tmp_file, path)
+            block_rows = max(1, READ_BLOCK_CELLS // max(shape[1], 1))
+        else:
+            out = np.empty(shape, dtype=np.float64)
+            block_rows = max(shape[0], 1)
+
+        for row in range(0, shape[0], block_rows):
+            block = out[row:row + block_rows]
+            if self.in_file is not None:
+                block[:] = self.dataset.read(self.band, window=Window(col_off, row_off + row, shape[1], len(block)))
+            else:
+                block[:] = self.array[row_off + row:row_off + row + len(block), col_off:col_off + shape[1]]
+            self.mask_no_data(block)
+        return out
+
+    def mask_no_data(self, values):
+        """Set no data cells of a float array to NaN (or the no data rule's replacement), in place"""
+        if self.nodata is not None:
+            values[values == self.nodata] = np.nan
+        if self.no_data_rule is not None:
+            op, value, replacement = self.no_data_rule
+            with np.errstate(invalid="ignore"):
+                values[op(values, value)] = replacement
+
+    def window_transform(self, window):
+        from rasterio.windows import transform
+        return transform(window, self.transform)
+
+    def get_statistic(self, func=np.nanmean):
+        """Compute a statistic over the whole band, e.g. np.nanmean"""
+        return func(self.read())
+
+    def mask_to_single_vector(self, geometry, all_touched=False):
+        """
+        Crop the raster to a geometry (shapely or GeoJSON-like), setting cells outside of it to NaN.
+        Returns (array, meta), ready for RasterHandler(numpy_array=..., meta=...)
+        """
+        from rasterio.features import geometry_mask
+        from shapely.geometry import shape
+        geometry = shape(geometry) if isinstance(geometry, dict) else geometry
+        window = self.get_window(geometry.bounds)
+        if window is None:
+            raise ValueError("The geometry does not overlap the raster")
+        array = np.array(self.read(window))
+        transform = self.window_transform(window)
+        outside = geometry_mask([geometry], out_shape=array.shape, transform=transform, all_touched=all_touched)
+        array[outside] = np.nan
+        meta = dict(self.meta, transform=transform, height=array.shape[0], width=array.shape[1],
+                    dtype="float64", nodata=np.nan, crs=self.crs, count=1)
+        return array, meta
+
+    def _to_raster_crs(self, gdf):
+        """Reproject a GeoDataFrame to the raster's CRS, when both are known"""
+        if self.crs is not None and gdf.crs is not None:
+            return gdf.to_crs(self.crs)
+        return gdf
+
+    def zonal_statistics(self, polygons, stats=ZONAL_STATISTICS, all_touched=False):
+        """
+        Summarize the cells under each polygon of a handler or GeoDataFrame.
+        The window under all polygons is read once, and polygons are rasterized together into a label grid,
+        with overlapping polygons (common for storm warnings) split over as few rasterizations as needed.
+        Statistics then come from bincounts over the labels, not one mask per polygon.
+        :return: DataFrame indexed like the polygons, with one column per statistic
+        """
+        from rasterio.features import rasterize
+        gdf = polygons.gdf if isinstance(polygons, AbstractGeoHandler) else polygons
+        gdf = self._to_raster_crs(gdf)
+        n = len(gdf)
+        result = {s: np.full(n, np.nan) for s in stats}
+        if "count" in result:
+            result["count"] = np.zeros(n)
+        window = self.get_window(gdf.total_bounds) if n else None
+        if window is None:
+            return pd.DataFrame(result, index=gdf.index)
+
+        values = self.read(window)
+        transform = self.window_transform(window)
+        valid = ~np.isnan(values)
+        geometries = list(gdf.geometry)
+        totals = {"count": np.zeros(n + 1), "sum": np.zeros(n + 1), "squares": np.zeros(n + 1),
+                  "min": np.full(n + 1, np.inf), "max": np.full(n + 1, -np.inf)}
+        for layer in overlap_layers(gdf):
+            labels = rasterize(((geometries[i], i + 1) for i in layer), out_shape=values.shape,
+                               transform=transform, fill=0, all_touched=all_touched, dtype="int32")
+            inside = valid & (labels > 0)
+            label = labels[inside]
+            cells = values[inside]
+            totals["count"] += np.bincount(label, minlength=n + 1)
+            totals["sum"] += np.bincount(label, weights=cells, minlength=n + 1)
+            totals["squares"] += np.bincount(label, weights=cells ** 2, minlength=n + 1)
+            np.minimum.at(totals["min"], label, cells)
+            np.maximum.at(totals["max"], label, cells)
+
+        count = totals["count"][1:]
+        has = count > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = totals["sum"][1:] / count
+            computed = {
+                "count": count,
+                "sum": np.where(has, totals["sum"][1:], np.nan),
+                "mean": mean,
+                "std": np.sqrt(np.maximum(totals["squares"][1:] / count - mean ** 2, 0)),
+                "min": np.where(has, totals["min"][1:], np.nan),
+                "max": np.where(has, totals["max"][1:], np.nan),
+            }
+        for s in stats:
+            result[s] = computed[s]
+        return pd.DataFrame(result, index=gdf.index)
+
+    def get_vector_raster_associations(self, handler, stats=ZONAL_STATISTICS):
+        """Join the zonal statistics of a polygon handler's features onto its GeoDataFrame"""
+        return handler.gdf.join(self.zonal_statistics(handler, stats=stats).add_prefix(
+            "" if self.name is None else self.name + "_"))
+
+    def sample_points(self, points):
+        """
+        Sample the raster at every point of a handler or GeoDataFrame, vectorized.
+        Only the window covering the points is read.  Points off the raster get NaN.
+        :return: Series indexed like the points
+        """
+        gdf = points.gdf if isinstance(points, AbstractGeoHandler) else points
+        gdf = self._to_raster_crs(gdf)
+        xs = gdf.geometry.x.to_numpy()
+        ys = gdf.geometry.y.to_numpy()
+        return pd.Series(self.sample_xy(xs, ys), index=gdf.index, name=self.name)
+
+    def sample_xy(self, xs, ys):
+        """Sample the raster at arrays of x and y, in the raster's CRS"""
+        out = np.full(len(xs), np.nan)
+        if len(xs) == 0:
+            return out
+        cols, rows = ~self.transform * (np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        rows = np.floor(rows).astype(np.intp)
+        cols = np.floor(cols).astype(np.intp)
+        height, width = self.shape
+        on_raster = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        if not on_raster.any():
+            return out
+        from rasterio.windows import Window
+        row0, col0 = rows[on_raster].min(), cols[on_raster].min()
+        window = Window(col0, row0, cols[on_raster].max() - col0 + 1, rows[on_raster].max() - row0 + 1)
+        values = self.read(window)
+        out[on_raster] = values[rows[on_raster] - row0, cols[on_raster] - col0]
+        return out
+
+
+def overlap_layers(gdf):
+    """
+    Split polygons into layers of mutually non-overlapping polygons, greedily, using the spatial index.
+    Each layer can then be rasterized in one pass without polygons overwriting each other.
+    Returns a list of lists of positions
+    """
+    geometries = list(gdf.geometry)
+    sindex = gdf.sindex
+    layer_of = np.full(len(geometries), -1)
+    layers = []
+    for i, geometry in enumerate(geometries):
+        taken = set()
+        for j in sindex.intersection(geometry.bounds):
+            if layer_of[j] >= 0 and j != i and geometry.intersection(geometries[j]).area > 0:
+                taken.add(layer_of[j])
+        layer = next(k for k in range(len(layers) + 1) if k not in taken)
+        if layer == len(layers):
+            layers.append([])
+        layers[layer].append(i)
+        layer_of[i] = layer
+    return layers
+
+
+class NetCDFHandler:
+    """
+    Handler for a gridded time series in a NetCDF file, e.g. MRMS or Stage IV precipitation.
+    The file is opened lazily, and its time axis is indexed once.  Sampling reads only the time steps and
+    the block of cells touched by the points, one read per time step.
+    Attributes:
+        - in_file: path of the NetCDF file
+        - variable: name of the gridded variable, with dimensions t_name, y_name and x_name in any order
+        - crs: CRS of the x and y coordinates
+    """
+
+    def __init__(self, in_file, variable, x_name="lon", y_name="lat", t_name="time", crs="EPSG:4326"):
+        self.in_file = in_file
+        self.variable = variable
+        self.x_name = x_name
+        self.y_name = y_name
+        self.t_name = t_name
+        self.crs = crs
+        self._dataset = None
+        self._axes = None
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            import netCDF4
+            self._dataset = netCDF4.Dataset(self.in_file)
+        return self._dataset
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+            self._dataset = None
+
+    def get_axes(self):
+        """The time (datetime64[s]), y and x coordinate arrays, read once"""
+        if self._axes is None:
+            import netCDF4
+            t = self.dataset.variables[self.t_name]
+            times = netCDF4.num2date(t[:], t.units, getattr(t, "calendar", "standard"),
+                                     only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+            self._axes = (
+                np.array(times, dtype="datetime64[s]"),
+                np.asarray(self.dataset.variables[self.y_name][:], dtype=np.float64),
+                np.asarray(self.dataset.variables[self.x_name][:], dtype=np.float64),
+            )
+        return self._axes
+
+    @staticmethod
+    def fractional_index(coordinates, values):
+        """Position of values along a monotonic coordinate axis, in fractional cells; NaN off the axis"""
+        if coordinates[0] > coordinates[-1]:
+            return len(coordinates) - 1 - NetCDFHandler.fractional_index(coordinates[::-1], values)
+        return np.interp(values, coordinates, np.arange(len(coordinates)), left=np.nan, right=np.nan)
+
+    def read_block(self, t0, t1, rows, cols):
+        """Read time steps t0 to t1 (inclusive) over the rows and cols slices, as a float (t, y, x) array"""
+        var = self.dataset.variables[self.variable]
+        slices = {self.t_name: slice(t0, t1 + 1), self.y_name: rows, self.x_name: cols}
+        block = var[tuple(slices[d] for d in var.dimensions)]
+        order = [var.dimensions.index(d) for d in (self.t_name, self.y_name, self.x_name)]
+        return np.ma.filled(np.ma.asarray(block, dtype=np.float64), np.nan).transpose(order)
+
+    def sample(self, handler, windows=(1, 3, 6), method="nearest", time_method="nearest"):
+        """
+        Sample the grid at every point of an AbstractTimePointEvent handler, in (x, y, t).
+        method is "nearest" or "bilinear" in space.  time_method is "nearest", or "next" to take the first
+        time step at or after each point, for accumulations stamped at the end of their period.
+        windows are trailing accumulation periods in hours, summing the time steps in (t - window, t].
+        Points off the grid get NaN, as do points outside its time axis: more than half a step beyond either end,
+        or for "next", after the last step or more than a step before the first.
+        :return: DataFrame indexed like the handler's gdf, with 'value' and one 'accum_<h>h' column per window
+        """
+        if method not in ("nearest", "bilinear"):
+            raise ValueError("method must be nearest or bilinear")
+        times, ys, xs = self.get_axes()
+        gdf = handler.gdf.to_crs(self.crs) if handler.gdf.crs is not None and self.crs is not None else handler.gdf
+        px = gdf.geometry.x.to_numpy(dtype=np.float64)
+        # Grids on 0-360 longitudes
+        if xs.max() > 180 and (px < 0).any():
+            px = np.where(px < 0, px + 360, px)
+        rows = self.fractional_index(ys, gdf.geometry.y.to_numpy(dtype=np.float64))
+        cols = self.fractional_index(xs, px)
+
+        point_times = pd.to_datetime(handler.gdf[handler.t_field]).to_numpy().astype("datetime64[s]")
+        step = np.timedelta64(int(np.median(np.diff(times).astype(np.int64))) if len(times) > 1 else 0, "s")
+        after = np.clip(np.searchsorted(times, point_times, side="left"), 0, len(times) - 1)
+        if time_method == "next":
+            t_index = after
+            in_time = (point_times >= times[0] - step) & (point_times <= times[-1])
+        else:
+            before = np.clip(after - 1, 0, len(times) - 1)
+            t_index = np.where(np.abs(times[before] - point_times) < np.abs(times[after] - point_times),
+                               before, after)
+            in_time = (point_times >= times[0] - step // 2) & (point_times <= times[-1] + step // 2)
+        starts = {w: np.searchsorted(times, times[t_index] - np.timedelta64(int(w * 3600), "s"), side="right")
+                  for w in windows}
+        first = np.minimum.reduce([t_index] + list(starts.values()))
+
+        n = len(gdf)
+        result = {"value": np.full(n, np.nan)}
+        result.update({"accum_{}h".format(w): np.full(n, np.nan) for w in windows})
+        on_grid = ~np.isnan(rows) & ~np.isnan(cols) & in_time
+        for ti in np.unique(t_index[on_grid]):
+            members = np.flatnonzero(on_grid & (t_index == ti))
+            r, c = rows[members], cols[members]
+            row0, col0 = int(np.floor(r.min())), int(np.floor(c.min()))
+            row1 = min(int(np.ceil(r.max())), len(ys) - 1)
+            col1 = min(int(np.ceil(c.max())), len(xs) - 1)
+            t0 = int(first[members].min())
+            block = self.read_block(t0, ti, slice(row0, row1 + 1), slice(col0, col1 + 1))
+            series = self.interpolate(block, r - row0, c - col0, method)
+            # Cumulative sums over time give every trailing window with one subtraction
+            cumulative = np.vstack([np.zeros(len(members)), np.cumsum(series, axis=0)])
+            result["value"][members] = series[-1]
+            columns = np.arange(len(members))
+            for w, start in starts.items():
+                result["accum_{}h".format(w)][members] = cumulative[-1] - cumulative[start[members] - t0, columns]
+        return pd.DataFrame(result, index=handler.gdf.index)
+
+    @staticmethod
+    def interpolate(block, rows, cols, method):
+        """Gather a (t, y, x) block at fractional rows and cols; returns a (t, points) array"""
+        if method == "nearest":
+            r = np.clip(np.rint(rows).astype(np.intp), 0, block.shape[1] - 1)
+            c = np.clip(np.rint(cols).astype(np.intp), 0, block.shape[2] - 1)
+            return block[:, r, c]
+        r0 = np.floor(rows).astype(np.intp)
+        c0 = np.floor(cols).astype(np.intp)
+        fr, fc = rows - r0, cols - c0
+        r1 = np.minimum(r0 + 1, block.shape[1] - 1)
+        c1 = np.minimum(c0 + 1, block.shape[2] - 1)
+        return (block[:, r0, c0] * (1 - fr) * (1 - fc) + block[:, r0, c1] * (1 - fr) * fc +
+                block[:, r1, c0] * fr * (1 - fc) + block[:, r1, c1] * fr * fc)
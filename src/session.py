@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+import pandas as pd
+from src.spacetime.spacetime_handlers import AbstractGeoHandler
+from src.spacetime.spacetime_analytics import SpaceTimePointStatistics
+
+"""
+Analysis sessions: a storm's handlers, its extent and everything derived from them, saved to one directory.
+Handlers are pickled along with their caches (projected coordinates, feature bounds),
+session artifacts such as calibrated thresholds go to an npz of arrays, a pickle of pandas frames
+(e.g. distance matrices) and a JSON manifest, so reloading a session skips the fetching, parsing,
+clipping and projection of the inputs entirely.
+The manifest records the hash of every input file and of the extent, and a session whose inputs
+or extent have changed is rebuilt.
+"""
+
+MANIFEST = "manifest.json"
+SESSION_FORMAT = 2
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """SHA-1 of a file's contents, read in chunks"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def describe_file(path):
+    """The size, modification time and hash of an input file"""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": hash_file(path)}
+
+
+def hash_extent(extent):
+    """SHA-1 of an extent's temporal bounds and the WKB of its spatial extent; None without an extent"""
+    if extent is None:
+        return None
+    h = hashlib.sha1()
+    for t in extent.temporal:
+        h.update(pd.Timestamp(t).isoformat().encode())
+    for g in extent.spatial.gdf.geometry:
+        h.update(g.wkb)
+    return h.hexdigest()
+
+
+def input_changed(path, recorded):
+    """Whether an input file differs from its recorded description.
+    Files with the recorded size and modification time are assumed unchanged, without hashing them"""
+    if not os.path.exists(path):
+        return True
+    stat = os.stat(path)
+    if stat.st_size != recorded["size"]:
+        return True
+    if stat.st_mtime_ns == recorded["mtime_ns"]:
+        return False
+    return hash_file(path) != recorded["sha1"]
+
+
+class AnalysisSession:
+    """
+    A named set of handlers, e.g. {"waze": ..., "lsrs": ...}, with the extent they were cut to,
+    the input files they were built from, and artifacts derived from them.
+    Artifacts are numpy arrays, pandas frames, or JSON serializable values like thresholds.
+    """
+
+    def __init__(self, name, extent=None, inputs=()):
+        self.name = name
+        self.extent = extent
+        self.inputs = [os.path.abspath(i) for i in inputs]
+        self.handlers = {}
+        self.artifacts = {}
+
+    def __getitem__(self, key):
+        return self.handlers[key]
+
+    def add_handler(self, key, handler):
+        self.handlers[key] = handler
+
+    def set_artifact(self, key, value):
+        self.artifacts[key] = value
+
+    def get_artifact(self, key, default=None):
+        return self.artifacts.get(key, default)
+
+    def warm(self):
+        """Compute the derived arrays of every handler, so they are saved with the session"""
+        for handler in self.handlers.values():
+            if isinstance(handler, AbstractGeoHandler):
+                handler.get_feature_bounds()
+            if isinstance(handler, SpaceTimePointStatistics):
+                handler.get_space_time_arrays()
+
+    def save(self, directory):
+        """
+        Write the session to a directory, replacing any session already there.
+        The session is written next to it first, so an interrupted save leaves the previous one intact.
+        """
+        directory = os.path.abspath(directory)
+        tmp_dir = directory + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        for key, handler in self.handlers.items():
+            with open(os.path.join(tmp_dir, key + ".pkl"), "wb") as f:
+                pickle.dump(handler, f, protocol=pickle.HIGHEST_PROTOCOL)
+                # Caches aren't pickled with the handler, as they are only valid for its current gdf version
+                caches = handler.get_saved_caches() if isinstance(handler, AbstractGeoHandler) else {}
+                pickle.dump(caches, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp_dir, "extent.pkl"), "wb") as f:
+            pickle.dump(self.extent, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        arrays = {k: v for k, v in self.artifacts.items() if isinstance(v, np.ndarray)}
+        np.savez(os.path.join(tmp_dir, "artifacts.npz"), **arrays)
+        frames = {k: v for k, v in self.artifacts.items() if isinstance(v, (pd.DataFrame, pd.Series))}
+        with open(os.path.join(tmp_dir, "frames.pkl"), "wb") as f:
+            pickle.dump(frames, f, protocol=pickle.HIGHEST_PROTOCOL)
+        manifest = {
+            "format": SESSION_FORMAT,
+            "name": self.name,
+            "handlers": list(self.handlers),
+            "arrays": list(arrays),
+            "frames": list(frames),
+            "values": {k: v for k, v in self.artifacts.items() if k not in arrays and k not in frames},
+            "inputs": {path: describe_file(path) for path in self.inputs},
+            "extent": hash_extent(self.extent)
+        }
+        with open(os.path.join(tmp_dir, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2, default=lambda o: o.item() if isinstance(o, np.generic) else str(o))
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_dir, directory)
+
+    @staticmethod
+    def read_manifest(directory):
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+
+    @classmethod
+    def get_stale_inputs(cls, directory):
+        """The input files that have changed since the session in directory was saved"""
+        manifest = cls.read_manifest(directory)
+        return [path for path, recorded in manifest["inputs"].items() if input_changed(path, recorded)]
+
+    @classmethod
+    def is_stale(cls, directory, extent=None):
+        """
+        Whether the session in directory is missing, from another format, or built from changed inputs.
+        With an extent, a session cut to a different extent is stale too.
+        """
+        if not os.path.exists(os.path.join(directory, MANIFEST)):
+            return True
+        manifest = cls.read_manifest(directory)
+        if manifest.get("format") != SESSION_FORMAT:
+            return True
+        if extent is not None and manifest.get("extent") != hash_extent(extent):
+            return True
+        return len(cls.get_stale_inputs(directory)) > 0
+
+    @classmethod
+    def load(cls, directory, check_inputs=True):
+        """Load a saved session, with the handlers' caches restored"""
+        manifest = cls.read_manifest(directory)
+        if manifest.get("format") != SESSION_FORMAT:
+            raise ValueError("Session {} was saved in an unsupported format".format(directory))
+        if check_inputs:
+            stale = cls.get_stale_inputs(directory)
+            if stale:
+                raise ValueError("Inputs of session {} have changed: {}".format(directory, stale))
+
+        session = cls(manifest["name"])
+        session.inputs = list(manifest["inputs"])
+        with open(os.path.join(directory, "extent.pkl"), "rb") as f:
+            session.extent = pickle.load(f)
+        for key in manifest["handlers"]:
+            with open(os.path.join(directory, key + ".pkl"), "rb") as f:
+                handler = pickle.load(f)
+                caches = pickle.load(f)
+            for name, value in caches.items():
+                handler.set_cached(name, value)
+            session.handlers[key] = handler
+
+        session.artifacts.update(manifest["values"])
+        with np.load(os.path.join(directory, "artifacts.npz")) as arrays:
+            session.artifacts.update({k: arrays[k] for k in manifest["arrays"]})
+        with open(os.path.join(directory, "frames.pkl"), "rb") as f:
+            session.artifacts.update(pickle.load(f))
+        return session
+
+    @classmethod
+    def load_or_build(cls, directory, build, extent=None):
+        """
+        Load the session in directory if it is up to date (and cut to extent, if given),
+        otherwise call build() for a new session, warm it and save it to directory.
+        """
+        if not cls.is_stale(directory, extent=extent):
+            return cls.load(directory, check_inputs=False)
+        session = build()
+        session.warm()
+        session.save(directory)
+        return session
@@ -1,4 +1,6 @@
 from src.spacetime.spacetime_handlers import AbstractGeoHandler, AbstractTimePointEvent
+from src.spacetime.spacetime_kde import KERNEL_REACH, kde_grid, select_bandwidth
+from src.spacetime.spacetime_keys import get_space_time_keys, get_neighbour_keys, get_time_buckets, join_keys
 import pandas as pd
 import geopandas as gpd
 import numpy as np
@@ -14,6 +16,23 @@ class SpaceTimePointStatistics:
     t_field: str = None
     gdf: gpd.GeoDataFrame = None
 
+    def get_space_time_arrays(self):
+        """
+        Get the equidistant x, y coordinates (n by 2, metres) and epoch seconds of every point.
+        Cached until the handler's gdf changes.
+        """
+        def compute():
+            return get_equidistant_coordinates(self.gdf), get_epoch_seconds(self.gdf[self.t_field])
+        if isinstance(self, AbstractGeoHandler):
+            return self.cached("space_time_arrays", compute)
+        return compute()
+
+    def extend_space_time_arrays(self, space_time_arrays, gdf):
+        """Extend the cached arrays with rows appended by AbstractGeoHandler.append_table"""
+        xy, t = space_time_arrays
+        return (np.vstack([xy, get_equidistant_coordinates(gdf)]),
+                np.concatenate([t, get_epoch_seconds(gdf[self.t_field])]))
+
     def k_function(self):
         """SOURCE:
         Lloyd, C D. (2010).
@@ -59,6 +78,33 @@ class SpaceTimePointStatistics:
 
         return output
 
+    def intensity_surface(self, cell_size=1000.0, bandwidth="scott", kernel="gaussian", extent=None, time_step=None):
+        """
+        Gridded kernel intensity of the points, in points per square metre, by binned FFT KDE.
+        The grid has cells of cell_size metres over the equidistant bounds of extent (an AbstractGeoHandler,
+        e.g. the storm extent), or of the points, padded by the kernel's reach so the surface integrates
+        to the number of points.  With extent, points outside it are left out, and the kernels of points
+        near its edges are cut off there, so the surface integrates to a little less than the points inside.
+        With time_step (seconds), the surface is space-time: a stack of grids, one per time step,
+        in points per square metre per second; bandwidth is then given for x, y and t.
+        :return: (list of grid axes, intensity array)
+        """
+        xy, t = self.get_space_time_arrays()
+        points = xy if time_step is None else np.column_stack([xy, t])
+        bandwidth = select_bandwidth(points, bandwidth)
+        if extent is None:
+            pad = bandwidth * KERNEL_REACH[kernel]
+            grid_min, grid_max = points.min(axis=0) - pad, points.max(axis=0) + pad
+        else:
+            bounds = get_equidistant_dataframe(extent.gdf).total_bounds
+            grid_min, grid_max = bounds[:2], bounds[2:]
+            if time_step is not None:
+                grid_min, grid_max = np.r_[grid_min, t.min()], np.r_[grid_max, t.max()]
+        steps = [cell_size, cell_size] + ([] if time_step is None else [time_step])
+        grid_size = np.maximum(np.ceil((np.asarray(grid_max) - grid_min) / steps).astype(int) + 1, 2)
+        grid_max = grid_min + (grid_size - 1) * np.asarray(steps)
+        return kde_grid(points, bandwidth, grid_min, grid_max, grid_size, kernel=kernel, normalize=False)
+
     def bivariate_spatial_distance_matrix(self, other):
         """Create a bivariate, m by n spatial distance matrix
         Columns are from this dataframe, rows/index are from 'other'"""
@@ -111,6 +157,141 @@ class SpaceTimePointStatistics:
             )
         return figure
 
+    def space_time_neighbour_counts(self, spatial_distance, time_window, other=None):
+        """
+        Count the points of 'other' within spatial_distance metres and time_window seconds of each point.
+        If other is None, counts are against this handler, and include the point itself.
+        Uses a KD-tree instead of dense distance matrices.
+        :return: Series indexed like this handler's gdf
+        """
+        other = self if other is None else other
+        xy, t = self.get_space_time_arrays()
+        other_xy, other_t = other.get_space_time_arrays()
+        counts = space_time_neighbour_counts(xy, t, other_xy, other_t, spatial_distance, time_window)
+        return pd.Series(counts, index=self.gdf.index)
+
+    def get_space_time_keys(self, level, time_width):
+        """
+        One integer per point for its cell at a level and its time bucket, time_width seconds wide,
+        for sorting, grouping and hash joins.  See spacetime_keys.
+        """
+        buckets = get_time_buckets(self.get_space_time_arrays()[1], time_width)
+        return get_space_time_keys(self.get_cell_keys(level), level, buckets)
+
+    def count_by_space_time_cell(self, level, time_width):
+        """The number of points in each occupied space-time cell, indexed by space-time key"""
+        return pd.Series(self.get_space_time_keys(level, time_width)).value_counts().sort_index()
+
+    def cell_neighbour_pairs(self, level, time_width, other=None):
+        """
+        Candidate pairs of points (positions in this handler, and in 'other') in the same or adjacent cells
+        at a level, and the same or adjacent time buckets, found by a hash join of integer keys.
+        With cells at least spatial_distance wide and buckets at least time_window long, every pair within
+        spatial_distance and time_window is among the candidates.
+        If other is None, pairs are within this handler, and include each point with itself.
+        """
+        other = self if other is None else other
+        cells = get_neighbour_keys(self.get_cell_keys(level), level)
+        buckets = get_time_buckets(self.get_space_time_arrays()[1], time_width)[:, None]
+        keys = np.hstack([get_space_time_keys(cells, level, buckets + dt) for dt in (-1, 0, 1)])
+        return join_keys(keys, other.get_space_time_keys(level, time_width))
+
+    def temporal_neighbour_counts(self, time_window, other=None, groups=None, other_groups=None):
+        """
+        Count the points of 'other' less than time_window seconds from each point, ignoring space.
+        If other is None, counts are against this handler, and include the point itself.
+        groups (and other_groups) restrict counts to points of the same group; see temporal_neighbour_counts.
+        :return: Series indexed like this handler's gdf
+        """
+        t = self.get_space_time_arrays()[1]
+        other_t = None if other is None else other.get_space_time_arrays()[1]
+        counts = temporal_neighbour_counts(t, time_window, other_t=other_t, groups=groups, other_groups=other_groups)
+        return pd.Series(counts, index=self.gdf.index)
+
+    def nearest_reference_event(self, reference, temporal_filter=(-6*60*60, 1*60*60),
+                                max_distance=np.inf, exclude_self=False, exclude_coincident=False):
+        """
+        Find the nearest reference event (e.g. LSR) of every point, among the references with
+        temporal_filter[0] < (point time - reference time) < temporal_filter[1] seconds.
+        Replaces taking the minimum of a dense, temporally filtered distance matrix.
+        Set exclude_self when reference is this handler, and exclude_coincident to also skip references
+        at a point's own location (distance 0), as the d[d != 0] of a dense matrix did.
+        :return: DataFrame indexed like this gdf, with nearest_distance (metres) and nearest_index
+        (the reference's index label); both are null where no reference is within the window
+        """
+        xy, t = self.get_space_time_arrays()
+        ref_xy, ref_t = reference.get_space_time_arrays()
+        distance, position = nearest_in_time_window(xy, t, ref_xy, ref_t, temporal_filter,
+                                                    max_distance=max_distance, exclude_self=exclude_self,
+                                                    exclude_coincident=exclude_coincident)
+        found = position >= 0
+        nearest_index = pd.Series(None, index=self.gdf.index, dtype=object)
+        nearest_index[found] = reference.gdf.index[position[found]]
+        return pd.DataFrame({"nearest_distance": np.where(found, distance, np.nan),
+                             "nearest_index": nearest_index}, index=self.gdf.index)
+
+    def cluster_duplicates(self, spatial_distance, time_window):
+        """
+        Group near-duplicate points into space-time clusters: points within spatial_distance metres
+        and time_window seconds of each other are linked, and linked points share a cluster.
+        The representative of each cluster is its earliest point.
+        :return: DataFrame indexed like this gdf, with cluster ids and is_representative
+        """
+        xy, t = self.get_space_time_arrays()
+        labels, is_representative = cluster_duplicate_points(xy, t, spatial_distance, time_window)
+        return pd.DataFrame({"cluster": labels, "is_representative": is_representative}, index=self.gdf.index)
+
+    def deduplicate(self, reference, spatial_distance, time_window, new_distance,
+                    temporal_filter=(-6*60*60, 1*60*60)):
+        """
+        Decide which points are new, and collapse near-duplicates, in one pass.
+        A point is new when no reference event within temporal_filter is closer than new_distance metres.
+        Near-duplicate points are clustered with cluster_duplicates.
+        :return: DataFrame of nearest_distance, nearest_index, is_new, cluster and is_representative.
+        The nearest reference is only searched for within new_distance, and is null for new points.
+        """
+        nearest = self.nearest_reference_event(reference, temporal_filter=temporal_filter, max_distance=new_distance)
+        nearest["is_new"] = nearest["nearest_distance"].isnull()
+        return nearest.join(self.cluster_duplicates(spatial_distance, time_window))
+
+    def st_dbscan(self, spatial_eps, temporal_eps, min_samples):
+        """
+        ST-DBSCAN space-time clustering.
+        Points with at least min_samples points (themselves included) within spatial_eps metres
+        and temporal_eps seconds, inclusive, are core points; linked core points form clusters, and other points
+        within reach of a core point join its cluster.  Runs in near-linear time on the
+        space-time KD-tree, for well over 10^6 points.
+        See st_dbscan_parameters to run it from calibrated (S, T) thresholds.
+        :return: DataFrame indexed like this gdf, with cluster (-1 for noise) and is_core
+        """
+        xy, t = self.get_space_time_arrays()
+        labels, is_core = st_dbscan(xy, t, spatial_eps, temporal_eps, min_samples)
+        return pd.DataFrame({"cluster": labels, "is_core": is_core}, index=self.gdf.index)
+
+    def knox_test(self, spatial_distance, time_window, other=None, n_permutations=999, seed=0):
+        """
+        Knox test of space-time interaction: are pairs close in space (within spatial_distance metres)
+        more often close in time (within time_window seconds) than chance?
+        With other (e.g. LSRs against Waze), pairs are between the two handlers, and only this handler's
+        times are permuted.
+        :return: dict, see knox_test
+        """
+        xy, t = self.get_space_time_arrays()
+        other_xy, other_t = (None, None) if other is None else other.get_space_time_arrays()
+        return knox_test(xy, t, spatial_distance, time_window, other_xy=other_xy, other_t=other_t,
+                         n_permutations=n_permutations, seed=seed)
+
+    def mantel_test(self, max_distance, spatial_constant=1000.0, other=None, n_permutations=999, seed=0):
+        """
+        Mantel test of space-time interaction, correlating the spatial closeness of pairs with their time apart.
+        With other, pairs are between the two handlers, and only this handler's times are permuted.
+        :return: dict, see mantel_test
+        """
+        xy, t = self.get_space_time_arrays()
+        other_xy, other_t = (None, None) if other is None else other.get_space_time_arrays()
+        return mantel_test(xy, t, max_distance, spatial_constant=spatial_constant, other_xy=other_xy,
+                           other_t=other_t, n_permutations=n_permutations, seed=seed)
+
     @staticmethod
     def distance_to_n_points_by_observation(distance_matrix, n):
         """
@@ -151,8 +332,12 @@ class SpaceTimeContainment:
         t1 = time_duration_handler.t_end_field
         t = time_point_handler.t_field
 
-        # Create a spatial intersection
-        spatial_intersection = gpd.sjoin(time_point_handler.gdf, time_duration_handler.gdf, how="left", op="intersects")
+        # Create a spatial intersection, through the duration handler's polygon index if it has one
+        if hasattr(time_duration_handler, "sjoin_points"):
+            spatial_intersection = time_duration_handler.sjoin_points(time_point_handler.gdf)
+        else:
+            spatial_intersection = gpd.sjoin(time_point_handler.gdf, time_duration_handler.gdf, how="left",
+                                             op="intersects")
 
         # For points that had no spatial containment, set those fields to -1.  t_start_field
         spatial_intersection[t0] = \
@@ -214,3 +399,417 @@ def get_equidistant_dataframe(gdf):
     cc = CRS(wkt)
     return gdf.to_crs(cc)
 
+
+
+def get_equidistant_coordinates(gdf):
+    """Get the x, y coordinates of a point GeoDataFrame as an n by 2 array, in equidistant metres"""
+    g = get_equidistant_dataframe(gdf).geometry
+    return np.column_stack([g.x.to_numpy(dtype=np.float64), g.y.to_numpy(dtype=np.float64)])
+
+
+def get_epoch_seconds(times):
+    """Convert a Series of datetimes to a float array of seconds since the epoch"""
+    return pd.to_datetime(times).to_numpy().astype('datetime64[ns]').astype(np.int64) / 1e9
+
+
+def space_time_coordinates(xy, t, spatial_distance, time_window, t0=0.0):
+    """
+    Stack x, y and t into an n by 3 array, with t rescaled so that time_window seconds span
+    spatial_distance metres.  Points within spatial_distance and time_window of each other are then
+    within spatial_distance in the Chebyshev (max) metric, so one KD-tree query finds candidate pairs
+    in both space and time.
+    """
+    if spatial_distance <= 0 or time_window <= 0:
+        raise ValueError("spatial_distance and time_window must be positive")
+    return np.column_stack([xy, (t - t0) * (spatial_distance / time_window)])
+
+
+def space_time_neighbour_counts(xy, t, other_xy, other_t, spatial_distance, time_window):
+    """
+    For each point of (xy, t), count the points of (other_xy, other_t)
+    within spatial_distance and time_window.
+    Candidates come from one space-time KD-tree query, and are then filtered on exact distance.
+    """
+    from scipy.spatial import cKDTree
+    counts = np.zeros(len(xy), dtype=np.int64)
+    if len(xy) == 0 or len(other_xy) == 0:
+        return counts
+    t0 = min(t.min(), other_t.min())
+    pairs = cKDTree(space_time_coordinates(xy, t, spatial_distance, time_window, t0)).sparse_distance_matrix(
+        cKDTree(space_time_coordinates(other_xy, other_t, spatial_distance, time_window, t0)),
+        spatial_distance, p=np.inf, output_type='ndarray'
+    )
+    i, j = pairs['i'], pairs['j']
+    close = ((np.hypot(*(xy[i] - other_xy[j]).T) <= spatial_distance) &
+             (np.abs(t[i] - other_t[j]) <= time_window))
+    counts += np.bincount(i[close], minlength=len(xy))
+    return counts
+
+
+def _two_pointer_counts(t, other_t, time_window, inclusive):
+    """
+    For sorted t and other_t, count the other times within time_window of each time,
+    sweeping a window [lo, hi) over other_t that only ever moves forward.
+    """
+    counts = np.zeros(len(t), dtype=np.int64)
+    lo = 0
+    hi = 0
+    m = len(other_t)
+    for k in range(len(t)):
+        if inclusive:
+            while lo < m and other_t[lo] < t[k] - time_window:
+                lo += 1
+            while hi < m and other_t[hi] <= t[k] + time_window:
+                hi += 1
+        else:
+            while lo < m and other_t[lo] <= t[k] - time_window:
+                lo += 1
+            while hi < m and other_t[hi] < t[k] + time_window:
+                hi += 1
+        counts[k] = hi - lo
+    return counts
+
+
+# _two_pointer_counts compiled by numba, when available; False once the import has failed
+_compiled_two_pointer_counts = None
+
+
+def get_two_pointer_kernel():
+    """The numba-compiled two-pointer kernel, or None if numba isn't installed"""
+    global _compiled_two_pointer_counts
+    if _compiled_two_pointer_counts is None:
+        try:
+            import numba
+            _compiled_two_pointer_counts = numba.njit(cache=True, nogil=True)(_two_pointer_counts)
+        except ImportError:
+            _compiled_two_pointer_counts = False
+    return _compiled_two_pointer_counts or None
+
+
+def temporal_neighbour_counts(t, time_window, other_t=None, groups=None, other_groups=None, inclusive=False):
+    """
+    For each time of t, count the times of other_t within time_window seconds (|dt| < time_window,
+    or <= if inclusive).  If other_t is None, counts are among t, and include the time itself.
+    With groups (and other_groups, for other_t), only times in the same group are counted,
+    e.g. the Waze reports around each LSR, in one call for all of them.
+    Sorts once, then sweeps two pointers with numba if it is installed, or binary searches otherwise:
+    O(n log n) either way, against O(n^2) for a temporal distance matrix.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    if other_t is None:
+        other_t, other_groups = t, groups
+    other_t = np.asarray(other_t, dtype=np.float64)
+    if len(t) == 0 or len(other_t) == 0:
+        return np.zeros(len(t), dtype=np.int64)
+    if (groups is None) != (other_groups is None):
+        raise ValueError("Give groups for both t and other_t, or for neither")
+    if groups is not None:
+        # Offset each group's times past the range of the previous ones, so groups never count each other
+        _, codes = np.unique(np.concatenate([np.asarray(groups), np.asarray(other_groups)]), return_inverse=True)
+        t0 = min(t.min(), other_t.min())
+        stride = max(t.max(), other_t.max()) - t0 + 2 * time_window + 1
+        t = t - t0 + codes[:len(t)] * stride
+        other_t = other_t - t0 + codes[len(t):] * stride
+
+    order = np.argsort(t, kind='stable')
+    other_sorted = np.sort(other_t)
+    kernel = get_two_pointer_kernel()
+    if kernel is not None:
+        sorted_counts = kernel(t[order], other_sorted, float(time_window), inclusive)
+    else:
+        lo_side, hi_side = ('left', 'right') if inclusive else ('right', 'left')
+        sorted_counts = (np.searchsorted(other_sorted, t[order] + time_window, side=hi_side) -
+                         np.searchsorted(other_sorted, t[order] - time_window, side=lo_side))
+    counts = np.empty(len(t), dtype=np.int64)
+    counts[order] = sorted_counts
+    return counts
+
+
+def space_time_pairs(xy, t, spatial_distance, time_window):
+    """Find every pair of points (i < j) within spatial_distance and time_window of each other.
+    Returns the i and j arrays"""
+    from scipy.spatial import cKDTree
+    if len(xy) < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    tree = cKDTree(space_time_coordinates(xy, t, spatial_distance, time_window, t.min()))
+    pairs = tree.query_pairs(spatial_distance, p=np.inf, output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+    close = (np.hypot(*(xy[i] - xy[j]).T) <= spatial_distance) & (np.abs(t[i] - t[j]) <= time_window)
+    return i[close], j[close]
+
+
+def cluster_duplicate_points(xy, t, spatial_distance, time_window):
+    """
+    Link points within spatial_distance and time_window of each other into clusters.
+    Returns the cluster labels, and a boolean array marking each cluster's earliest point as its representative.
+    """
+    i, j = space_time_pairs(xy, t, spatial_distance, time_window)
+    labels = union_find_labels(len(xy), i, j)
+    # Sort by cluster, then time, so the first of each cluster is its representative
+    order = np.lexsort((t, labels))
+    is_representative = np.zeros(len(xy), dtype=bool)
+    if len(order):
+        is_representative[order[np.r_[True, labels[order][1:] != labels[order][:-1]]]] = True
+    return labels, is_representative
+
+
+def union_find_labels(n, i, j):
+    """
+    Union-find over n elements linked by the pairs (i, j), vectorized over all pairs at once:
+    each round hooks the larger root of every pair onto the smaller, then compresses paths.
+    Returns a component label per element, numbered from 0 in order of first appearance.
+    """
+    parent = np.arange(n)
+    i = np.asarray(i, dtype=np.intp)
+    j = np.asarray(j, dtype=np.intp)
+    while len(i):
+        root_i = parent[i]
+        root_j = parent[j]
+        linked = root_i != root_j
+        if not linked.any():
+            break
+        np.minimum.at(parent, np.maximum(root_i, root_j)[linked], np.minimum(root_i, root_j)[linked])
+        # Path compression, until every element points at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    _, first, labels = np.unique(parent, return_index=True, return_inverse=True)
+    # Renumber by first appearance
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[labels.ravel()]
+
+
+def nearest_in_time_window(xy, t, ref_xy, ref_t, temporal_filter, max_distance=np.inf, exclude_self=False,
+                           exclude_coincident=False):
+    """
+    For each point, find the nearest reference point with
+    temporal_filter[0] < t - ref_t < temporal_filter[1].
+    Returns arrays of the distance and the reference position (-1 where none was found).
+    """
+    distance, position = n_nearest_in_time_window(xy, t, ref_xy, ref_t, temporal_filter, 1,
+                                                  max_distance=max_distance, exclude_self=exclude_self,
+                                                  exclude_coincident=exclude_coincident)
+    return distance[:, 0], position[:, 0]
+
+
+def n_nearest_in_time_window(xy, t, ref_xy, ref_t, temporal_filter, n, max_distance=np.inf, exclude_self=False,
+                             exclude_coincident=False):
+    """
+    For each point, find the n nearest reference points with
+    temporal_filter[0] < t - ref_t < temporal_filter[1].
+    exclude_coincident skips references at distance 0, the point itself included.
+    Queries the k nearest references for all points at once, and widens k only for the points
+    with fewer than n of their k nearest inside the window.
+    Returns len(xy) by n arrays of distances and reference positions, sorted by distance,
+    padded with inf and -1 where fewer than n were found.
+    """
+    from scipy.spatial import cKDTree
+    distance = np.full((len(xy), n), np.inf)
+    position = np.full((len(xy), n), -1, dtype=np.intp)
+    m = len(ref_xy)
+    if len(xy) == 0 or m == 0:
+        return distance, position
+    tree = cKDTree(ref_xy)
+    pending = np.arange(len(xy))
+    k = min(max(8, 2 * n), m)
+    while len(pending):
+        d, j = tree.query(xy[pending], k=k, distance_upper_bound=max_distance)
+        d = d.reshape(len(pending), k)
+        j = j.reshape(len(pending), k)
+        # Missing neighbours come back as j == m
+        exists = j < m
+        j_safe = np.where(exists, j, 0)
+        dt = t[pending][:, None] - ref_t[j_safe]
+        ok = exists & (dt > temporal_filter[0]) & (dt < temporal_filter[1])
+        if exclude_self:
+            ok &= j_safe != pending[:, None]
+        if exclude_coincident:
+            ok &= d > 0
+        # Stop for points with n found, that ran out of references within max_distance,
+        # or once k covers every reference
+        done = (ok.sum(axis=1) >= n) | ~exists.all(axis=1) | (k >= m)
+        # Neighbours are sorted by distance, so the first n in the window are the nearest
+        columns = np.argsort(~ok[done], axis=1, kind='stable')[:, :n]
+        found = np.take_along_axis(ok[done], columns, axis=1)
+        width = columns.shape[1]
+        distance[pending[done], :width] = np.where(found, np.take_along_axis(d[done], columns, axis=1), np.inf)
+        position[pending[done], :width] = np.where(found, np.take_along_axis(j[done], columns, axis=1), -1)
+        pending = pending[~done]
+        k = min(k * 4, m)
+    return distance, position
+
+
+def st_dbscan(xy, t, spatial_eps, temporal_eps, min_samples):
+    """
+    ST-DBSCAN over the points (xy, t).
+    Returns cluster labels (numbered from 0, -1 for noise) and a boolean core point array.
+    """
+    n = len(xy)
+    i, j = space_time_pairs(xy, t, spatial_eps, temporal_eps)
+    neighbours = np.bincount(i, minlength=n) + np.bincount(j, minlength=n) + 1
+    is_core = neighbours >= min_samples
+
+    # Clusters are the connected components of core points
+    core_pairs = is_core[i] & is_core[j]
+    components = union_find_labels(n, i[core_pairs], j[core_pairs])
+    labels = np.where(is_core, components, -1)
+
+    # Border points take the cluster of their first core neighbour
+    border = np.concatenate([j[is_core[i] & ~is_core[j]], i[is_core[j] & ~is_core[i]]])
+    core = np.concatenate([i[is_core[i] & ~is_core[j]], j[is_core[j] & ~is_core[i]]])
+    order = np.lexsort((core, border))
+    border, core = border[order], core[order]
+    first = np.r_[True, border[1:] != border[:-1]] if len(border) else np.zeros(0, dtype=bool)
+    labels[border[first]] = components[core[first]]
+
+    # Renumber clusters from 0, in order of first appearance
+    clustered = labels >= 0
+    _, first_seen, inverse = np.unique(labels[clustered], return_index=True, return_inverse=True)
+    rank = np.empty(len(first_seen), dtype=np.intp)
+    rank[np.argsort(first_seen)] = np.arange(len(first_seen))
+    labels[clustered] = rank[inverse.ravel()]
+    return labels, is_core
+
+
+def st_dbscan_parameters(thresholds, time_window=30*60):
+    """
+    Convert the (spatial_distance_threshold, temporal_distance_threshold) calibrated in run.py into
+    st_dbscan arguments.  A report is validated when more than T reports, itself included, fall strictly
+    within S metres and time_window seconds, which makes it a core point with min_samples = T + 1.
+    st_dbscan's eps are inclusive, so they are taken one float below S and time_window, where <= is <.
+    """
+    spatial_distance_threshold, temporal_distance_threshold = thresholds
+    return {"spatial_eps": np.nextafter(float(spatial_distance_threshold), 0),
+            "temporal_eps": np.nextafter(float(time_window), 0),
+            "min_samples": int(temporal_distance_threshold) + 1}
+
+
+def spatial_pairs(xy, spatial_distance, other_xy=None):
+    """
+    Find the pairs of points within spatial_distance of each other with a KD-tree.
+    Without other_xy, pairs are within xy (i < j); otherwise i indexes xy and j other_xy.
+    Returns the i, j and distance arrays
+    """
+    from scipy.spatial import cKDTree
+    if other_xy is None:
+        pairs = cKDTree(xy).query_pairs(spatial_distance, output_type='ndarray') if len(xy) > 1 \
+            else np.zeros((0, 2), dtype=np.intp)
+        i, j = pairs[:, 0], pairs[:, 1]
+        return i, j, np.hypot(*(xy[i] - xy[j]).T)
+    if len(xy) == 0 or len(other_xy) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+    pairs = cKDTree(xy).sparse_distance_matrix(cKDTree(other_xy), spatial_distance, output_type='ndarray')
+    return pairs['i'].astype(np.intp), pairs['j'].astype(np.intp), pairs['v']
+
+
+def count_time_close_pairs(t, time_window, other_t=None):
+    """Count all pairs within time_window of each other, in O(n log n) from sorted times"""
+    if other_t is None:
+        s = np.sort(t)
+        return int((np.searchsorted(s, s + time_window, side='right') - np.arange(1, len(s) + 1)).sum())
+    s = np.sort(other_t)
+    return int((np.searchsorted(s, t + time_window, side='right') -
+                np.searchsorted(s, t - time_window, side='left')).sum())
+
+
+def time_difference_moments(t, other_t=None):
+    """The sum and sum of squares of |t_i - t_j| over all pairs, in O(n log n)"""
+    if other_t is None:
+        s = np.sort(t)
+        n = len(s)
+        total = (s * (2 * np.arange(n) - n + 1)).sum()
+        squares = n * (s ** 2).sum() - s.sum() ** 2
+        return total, squares
+    s = np.sort(other_t)
+    prefix = np.r_[0.0, np.cumsum(s)]
+    below = np.searchsorted(s, t, side='right')
+    total = (t * below - prefix[below] + (prefix[-1] - prefix[below]) - t * (len(s) - below)).sum()
+    squares = len(s) * (t ** 2).sum() - 2 * t.sum() * s.sum() + len(t) * (s ** 2).sum()
+    return total, squares
+
+
+def permuted_times(t, rng, n_permutations):
+    """An n_permutations by n array of independent shuffles of t"""
+    return t[np.argsort(rng.random((n_permutations, len(t))), axis=1)]
+
+
+def _permutation_batches(n_permutations, width, max_elements=10**7):
+    """Split permutations into batches whose arrays stay under max_elements"""
+    batch = max(1, max_elements // max(width, 1))
+    return [min(batch, n_permutations - k) for k in range(0, n_permutations, batch)]
+
+
+def knox_test(xy, t, spatial_distance, time_window, other_xy=None, other_t=None, n_permutations=999, seed=0):
+    """
+    Knox test of space-time interaction.
+    Spatially close pairs are counted once with a KD-tree, and don't change when times are permuted,
+    so each Monte-Carlo permutation only re-tests those pairs in time, vectorized over a batch of permutations.
+    Times of (xy, t) are permuted; with other_xy/other_t the test is bivariate.
+    :return: dict with the observed count of pairs close in both space and time, its expectation under
+    independence, the 2 by 2 table of close/not close in space (rows) and time (columns),
+    and the Monte-Carlo p-value
+    """
+    i, j, _ = spatial_pairs(xy, spatial_distance, other_xy)
+    bivariate = other_xy is not None
+    reference_t = other_t if bivariate else None
+
+    def close_in_time(times):
+        second = other_t[j] if bivariate else times[..., j]
+        return np.count_nonzero(np.abs(times[..., i] - second) <= time_window, axis=-1)
+
+    observed = int(close_in_time(t))
+    n_pairs = len(t) * len(other_t) if bivariate else len(t) * (len(t) - 1) // 2
+    n_space = len(i)
+    n_time = count_time_close_pairs(t, time_window, reference_t)
+
+    rng = np.random.default_rng(seed)
+    permutations = np.concatenate([close_in_time(permuted_times(t, rng, b))
+                                   for b in _permutation_batches(n_permutations, max(len(t), len(i)))])
+    return {
+        "observed": observed,
+        "expected": n_space * n_time / n_pairs if n_pairs else np.nan,
+        "table": np.array([[observed, n_space - observed],
+                           [n_time - observed, n_pairs - n_space - n_time + observed]]),
+        "p_value": (1 + np.count_nonzero(permutations >= observed)) / (1 + n_permutations),
+        "permutations": permutations
+    }
+
+
+def mantel_test(xy, t, max_distance, spatial_constant=1000.0, other_xy=None, other_t=None,
+                n_permutations=999, seed=0):
+    """
+    Mantel test of space-time interaction, over all pairs.
+    Spatial closeness uses the reciprocal transform 1 / (d + spatial_constant), truncated to 0 beyond
+    max_distance so only KD-tree pairs contribute; the time term is |t_i - t_j|.
+    The moments of |t_i - t_j| over all pairs don't change under permutation, and come from sorted times,
+    so the correlation r is exact without a dense matrix.  Interaction makes r negative (close pairs are
+    close in time), and the p-value is one-sided in that direction.
+    :return: dict with the observed r, the Monte-Carlo p-value and the permuted r values
+    """
+    i, j, d = spatial_pairs(xy, max_distance, other_xy)
+    bivariate = other_xy is not None
+    a = 1.0 / (d + spatial_constant)
+    n_pairs = len(t) * len(other_t) if bivariate else len(t) * (len(t) - 1) // 2
+    b_sum, b_squares = time_difference_moments(t, other_t if bivariate else None)
+    a_mean = a.sum() / n_pairs
+    b_mean = b_sum / n_pairs
+    a_sd = np.sqrt(max((a ** 2).sum() / n_pairs - a_mean ** 2, 0.0))
+    b_sd = np.sqrt(max(b_squares / n_pairs - b_mean ** 2, 0.0))
+
+    def correlation(times):
+        second = other_t[j] if bivariate else times[..., j]
+        z = (a * np.abs(times[..., i] - second)).sum(axis=-1)
+        return (z / n_pairs - a_mean * b_mean) / (a_sd * b_sd)
+
+    observed = float(correlation(t))
+    rng = np.random.default_rng(seed)
+    permutations = np.concatenate([correlation(permuted_times(t, rng, b))
+                                   for b in _permutation_batches(n_permutations, max(len(t), len(i)))])
+    return {
+        "r": observed,
+        "p_value": (1 + np.count_nonzero(permutations <= observed)) / (1 + n_permutations),
+        "permutations": permutations
+    }
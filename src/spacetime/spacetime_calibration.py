@@ -0,0 +1,136 @@
+import sys
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+"""
+Memoization of the intermediates of the threshold calibration in run.py.
+The grid search over (n, p, time_window, temporal_filter) filters the same LSR/Waze distance matrices,
+and ranks them, for every combination.  CalibrationCache computes each temporal filter's mask and
+filtered matrices, each filter's ranking, and each n's radii once, and shares them across calls.
+Entries live in an LRU cache bounded by count and by size, as filtered matrices can be large.
+"""
+
+
+def size_of(value):
+    """Approximate size of a cached value in bytes"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True)))
+    if isinstance(value, (tuple, list)):
+        return sum(size_of(i) for i in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Least recently used cache, bounded by the number of entries and their total size in bytes.
+    Counts hits, misses and evictions, to confirm values are reused.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, compute):
+        """Get the value for key, calling compute() on a miss"""
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used until within bounds.
+        Values larger than max_bytes on their own aren't stored"""
+        size = size_of(value)
+        if key in self.entries:
+            self.bytes -= self.sizes.pop(key)
+            del self.entries[key]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            old_key, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(old_key)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "entries": len(self.entries), "bytes": self.bytes}
+
+
+class CalibrationCache:
+    """
+    Shared calibration intermediates for one pair of LSR/Waze matrices: distance_matrix in metres,
+    and time_matrix in seconds (Waze time - LSR time), both Waze reports by LSRs, as in run.py.
+    Keys are tuples starting with the kind of intermediate, so other results, like (S, T) per
+    (n, p, time_window, temporal_filter), can share the cache through memoize().
+    """
+
+    def __init__(self, distance_matrix, time_matrix, cache=None):
+        self.distance_matrix = distance_matrix
+        self.time_matrix = time_matrix
+        self.cache = LRUCache() if cache is None else cache
+
+    def memoize(self, key, compute):
+        return self.cache.get(key, compute)
+
+    def get_mask(self, temporal_filter):
+        """Where temporal_filter[0] < time < temporal_filter[1]"""
+        lo, hi = temporal_filter
+        return self.memoize(("mask", lo, hi), lambda: (self.time_matrix > lo) & (self.time_matrix < hi))
+
+    def get_filtered(self, temporal_filter):
+        """
+        The distance and time matrices, null outside the temporal filter.
+        The same as d0[t0 > lo][t0 < hi] and t0[t0 > lo][t0 < hi] in run.py.
+        """
+        lo, hi = temporal_filter
+
+        def compute():
+            mask = self.get_mask(temporal_filter)
+            return self.distance_matrix.where(mask), self.time_matrix.where(mask)
+        return self.memoize(("filtered", lo, hi), compute)
+
+    def get_ranks(self, temporal_filter):
+        """The rank of each filtered distance within its LSR, shared by every n"""
+        lo, hi = temporal_filter
+        return self.memoize(("ranks", lo, hi), lambda: self.get_filtered(temporal_filter)[0].rank())
+
+    def distance_to_n_points(self, n, temporal_filter):
+        """
+        The radius holding the n nearest Waze reports of each LSR within the temporal filter;
+        SpaceTimePointStatistics.distance_to_n_points_by_observation, from the shared ranks.
+        """
+        lo, hi = temporal_filter
+
+        def compute():
+            d = self.get_filtered(temporal_filter)[0]
+            return d[self.get_ranks(temporal_filter) <= float(n)].max()
+        return self.memoize(("n_rank", n, lo, hi), compute)
@@ -1,5 +1,14 @@
 import geopandas as gpd
+import itertools
+import numpy as np
+import pandas as pd
 import os.path
+from src.spacetime.spacetime_keys import MAX_LEVEL, get_cell_keys, coarsen_keys, get_representative_xy, \
+    get_time_buckets
+
+# Every assignment of a handler's gdf takes a new version from here.
+# Versions are unique across handlers, so caches can't confuse the data of a handler and its copies.
+_gdf_versions = itertools.count()
 
 
 class AbstractTimePointEvent:
@@ -16,6 +25,11 @@ class AbstractTimePointEvent:
         """Clip the data to a temporal extent"""
         self.gdf = self.gdf[self.gdf[self.t_field] < t1][self.gdf[self.t_field] > t0]
 
+    def get_time_buckets(self, time_width):
+        """The bucket of each point's time, time_width seconds wide, as integers"""
+        from src.spacetime.spacetime_analytics import get_epoch_seconds
+        return get_time_buckets(get_epoch_seconds(self.gdf[self.t_field]), time_width)
+
     def get_temporal_extent(self, as_datetime=False):
         """Get the temporal extent of the data"""
         min_time = min(self.gdf[self.gdf[self.t_field] != 0][self.t_field])
@@ -58,7 +72,9 @@ class AbstractTimeDurationEvent:
 class AbstractGeoHandler:
     """Handler for storing routine operations on GeoDataFrames."""
     get_gdf = None
-    gdf: gpd.GeoDataFrame = None
+    _gdf: gpd.GeoDataFrame = None
+    _gdf_version: int = None
+    _caches: dict = None
 
     def __init__(self, gdf):
         """
@@ -67,6 +83,93 @@ class AbstractGeoHandler:
         """
         self.gdf = gdf
 
+    @property
+    def gdf(self):
+        return self._gdf
+
+    @gdf.setter
+    def gdf(self, gdf):
+        self._gdf = gdf
+        self.invalidate_caches()
+
+    def invalidate_caches(self):
+        """Drop everything cached from the GDF.
+        Happens on every assignment to gdf; call it directly after changing geometries in place."""
+        self._gdf_version = next(_gdf_versions)
+        self._caches = {}
+
+    def cached(self, name, compute):
+        """Get an artifact derived from the GDF, computing it on first use"""
+        if self._caches is None:
+            self._caches = {}
+        if name not in self._caches:
+            self._caches[name] = compute()
+        return self._caches[name]
+
+    def set_cached(self, name, value):
+        """Store a precomputed artifact derived from the current GDF, e.g. one loaded from disk"""
+        if self._caches is None:
+            self._caches = {}
+        self._caches[name] = value
+
+    def get_saved_caches(self):
+        """
+        The caches worth saving with the handler, e.g. by AnalysisSession.
+        Classes list any caches that can't be pickled, like prepared geometries, in unsaved_caches.
+        """
+        unsaved = getattr(self, "unsaved_caches", ())
+        return {name: value for name, value in (self._caches or {}).items() if name not in unsaved}
+
+    def __getstate__(self):
+        """Caches aren't copied or pickled; copies and loaded handlers start with a new version"""
+        state = dict(self.__dict__)
+        state.pop("_caches", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.invalidate_caches()
+
+    def get_feature_bounds(self):
+        """Get the bounds of every feature as an n by 4 array of minx, miny, maxx, maxy.
+        Computed once, and kept outside of the GDF"""
+        return self.cached("feature_bounds", lambda: self.gdf.geometry.bounds.to_numpy(dtype=np.float64))
+
+    def get_total_bounds(self):
+        """Get the bounds of all features as an array of minx, miny, maxx, maxy"""
+        def compute():
+            b = self.get_feature_bounds()
+            return np.array([np.nanmin(b[:, 0]), np.nanmin(b[:, 1]), np.nanmax(b[:, 2]), np.nanmax(b[:, 3])])
+        return self.cached("total_bounds", compute)
+
+    def extend_feature_bounds(self, feature_bounds, gdf):
+        return np.vstack([feature_bounds, gdf.geometry.bounds.to_numpy(dtype=np.float64)])
+
+    def extend_total_bounds(self, total_bounds, gdf):
+        new_bounds = gdf.geometry.bounds.to_numpy(dtype=np.float64)
+        return np.concatenate([np.fmin(total_bounds[:2], np.nanmin(new_bounds[:, :2], axis=0)),
+                               np.fmax(total_bounds[2:], np.nanmax(new_bounds[:, 2:], axis=0))])
+
+    def get_cell_keys(self, level=MAX_LEVEL):
+        """
+        Integer keys of the quadtree cells holding each feature (its centroid, for non-points),
+        at a level from 0 to MAX_LEVEL; see spacetime_keys.  -1 marks missing geometries.
+        Keys are computed once at MAX_LEVEL, and coarsened by a bit shift.
+        """
+        def compute():
+            if hasattr(self, "get_space_time_arrays"):
+                # Point handlers already hold their projected coordinates
+                return get_cell_keys(self.get_space_time_arrays()[0])
+            return get_cell_keys(get_representative_xy(self.gdf))
+        return coarsen_keys(self.cached("cell_keys", compute), MAX_LEVEL, level)
+
+    def extend_cell_keys(self, cell_keys, gdf):
+        return np.concatenate([cell_keys, get_cell_keys(get_representative_xy(gdf))])
+
+    def count_by_cell(self, level):
+        """The number of features in each occupied cell at a level, indexed by cell key"""
+        return pd.Series(self.get_cell_keys(level)).value_counts().sort_index()
+
     def cut_data_by_values(self, keys):
         """Filter a dataframe by specific values"""
         x = self.gdf
@@ -75,34 +178,31 @@ class AbstractGeoHandler:
         self.gdf = x
 
     def create_spatial_index_fields(self):
-        """Potentially useful for spatial indexing and efficient calculation"""
-        bounds = self.gdf["geometry"].bounds
-        self.gdf["minx"] = bounds["minx"]
-        self.gdf["maxx"] = bounds["maxx"]
-        self.gdf["miny"] = bounds["miny"]
-        self.gdf["maxy"] = bounds["maxy"]
+        """Write the feature bounds into the GDF as minx, maxx, miny and maxy fields.
+        Not needed for extents or clipping, which use the cached bounds."""
+        bounds = self.get_feature_bounds()
+        self.gdf["minx"] = bounds[:, 0]
+        self.gdf["maxx"] = bounds[:, 2]
+        self.gdf["miny"] = bounds[:, 1]
+        self.gdf["maxy"] = bounds[:, 3]
 
     def clip_spatial(self, extent):
-        # TODO: try/except is currently implemented to handle empty dataframes.  Not optimal
         """Takes an extent (lower left, upper right) and clips the GDF to these bounds"""
         lower_left, upper_right = extent
         extent_min_lon, extent_min_lat = lower_left
         extent_max_lon, extent_max_lat = upper_right
-        try:
-            c1 = self.gdf["geometry"].bounds["minx"] < extent_max_lon
-            c2 = self.gdf["geometry"].bounds["maxx"] > extent_min_lon
-            c3 = self.gdf["geometry"].bounds["miny"] < extent_max_lat
-            c4 = self.gdf["geometry"].bounds["maxy"] > extent_min_lat
-            self.gdf = self.gdf[c1][c2][c3][c4]
-        except ValueError:
-            pass
+        bounds = self.get_feature_bounds()
+        self.gdf = self.gdf[(bounds[:, 0] < extent_max_lon) &
+                            (bounds[:, 2] > extent_min_lon) &
+                            (bounds[:, 1] < extent_max_lat) &
+                            (bounds[:, 3] > extent_min_lat)]
 
     def get_spatial_extent(self, buffer=0.01, as_geometry=False):
         """Get the spatial extent of the GeoDataFrame,
         potentially with a buffer or as a Shapely Polygon"""
-        self.create_spatial_index_fields()
-        pts = ((min(self.gdf["minx"])-buffer, min(self.gdf["miny"])-buffer),
-               (max(self.gdf["maxx"])+buffer, max(self.gdf["maxy"])+buffer))
+        minx, miny, maxx, maxy = self.get_total_bounds()
+        pts = ((minx-buffer, miny-buffer),
+               (maxx+buffer, maxy+buffer))
         if as_geometry:
             from shapely.geometry import Polygon
             return Polygon([(pts[0][0], pts[0][1]),
@@ -117,7 +217,168 @@ class AbstractGeoHandler:
         """Clip this GDF by another GDF"""
         self.gdf = gpd.clip(self.gdf, other_gdf)
 
-    #TODO add an append_table function
+    def append_table(self, gdf):
+        """
+        Append rows to the GDF.
+        Caches with an extend_<name>(value, gdf) method are extended with just the new rows,
+        rather than recomputed over the whole table; any others are dropped.
+        With integer indexes, the new rows are numbered on from the table's largest label, as their own
+        (e.g. a RangeIndex from a fetch) would repeat it; other indexes must not share labels.
+        """
+        if len(gdf) == 0:
+            return
+        index = self.gdf.index
+        if pd.api.types.is_integer_dtype(index) and pd.api.types.is_integer_dtype(gdf.index):
+            start = index.max() + 1 if len(index) else 0
+            gdf = gdf.set_index(pd.RangeIndex(start, start + len(gdf), name=index.name))
+        elif gdf.index.isin(index).any() or gdf.index.duplicated().any():
+            raise ValueError("The appended rows repeat index labels of the table")
+        extended = {}
+        for name, value in (self._caches or {}).items():
+            extend = getattr(self, "extend_" + name, None)
+            if extend is not None:
+                extended[name] = extend(value, gdf)
+        self.gdf = pd.concat([self.gdf, gdf], sort=False)
+        self._caches.update(extended)
+
+
+class PolygonIndex:
+    """
+    Acceleration layer for repeated point-in-polygon queries against a polygon AbstractGeoHandler,
+    such as storm warnings.  Built lazily and cached until the gdf changes:
+        - the per-polygon bounds arrays of AbstractGeoHandler
+        - an STRtree over the polygons
+        - prepared polygons, for the exact tests
+        - if simplify_tolerance is set, an inner and an outer band around each polygon, from a
+          topology-preserving simplified copy.  Points inside the inner band are inside the polygon,
+          points outside the outer band are outside it, and only points between the two are tested exactly.
+          The bands are used with shapely 2, where the tests are vectorized.
+    """
+    simplify_tolerance: float = None
+    # Prepared geometries can't be pickled, and the tree is cheap to rebuild
+    unsaved_caches = ("strtree", "prepared_geometries", "simplified_bands")
+
+    def get_strtree(self):
+        from shapely.strtree import STRtree
+        return self.cached("strtree", lambda: STRtree(list(self.gdf.geometry)))
+
+    def get_prepared_geometries(self):
+        from shapely.prepared import prep
+        return self.cached("prepared_geometries", lambda: [prep(g) for g in self.gdf.geometry])
+
+    def get_simplified_bands(self):
+        """
+        The (inner, outer) prepared bands of each polygon.
+        Simplifying moves the boundary by at most the tolerance, so shrinking and growing the simplified
+        polygon by twice the tolerance (leaving room for the buffer's approximation of arcs) gives a band
+        that always holds the true boundary.
+        """
+        from shapely.prepared import prep
+
+        def compute():
+            tolerance = self.simplify_tolerance
+            bands = []
+            for g in self.gdf.geometry:
+                simplified = g.simplify(tolerance, preserve_topology=True)
+                bands.append((prep(simplified.buffer(-2 * tolerance)), prep(simplified.buffer(2 * tolerance))))
+            return bands
+        return self.cached("simplified_bands", compute)
+
+    def query(self, geometry):
+        """Positions of the polygons whose bounds intersect a geometry, from the STRtree"""
+        result = self.get_strtree().query(geometry)
+        if len(result) and not isinstance(result[0], (int, np.integer)):
+            # Shapely < 2 returns the geometries themselves
+            positions = {id(g): i for i, g in enumerate(self.gdf.geometry)}
+            result = [positions[id(g)] for g in result]
+        return np.sort(np.asarray(result, dtype=np.intp))
+
+    def get_candidate_pairs(self, x, y):
+        """Pairs of (point position, polygon position) where the point is within the polygon's bounds"""
+        if has_vectorized_shapely():
+            # Query the STRtree for every point at once
+            import shapely
+            i, j = self.get_strtree().query(shapely.points(x, y))
+            return i.astype(np.intp), j.astype(np.intp)
+        # Otherwise, sweep the points sorted on x once per polygon
+        bounds = self.get_feature_bounds()
+        order = np.argsort(x, kind='stable')
+        sorted_x = x[order]
+        i, j = [], []
+        for k, (minx, miny, maxx, maxy) in enumerate(bounds):
+            candidates = order[np.searchsorted(sorted_x, minx, 'left'):np.searchsorted(sorted_x, maxx, 'right')]
+            candidates = candidates[(y[candidates] >= miny) & (y[candidates] <= maxy)]
+            i.append(candidates)
+            j.append(np.full(len(candidates), k, dtype=np.intp))
+        if not i:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        return np.concatenate(i), np.concatenate(j)
+
+    def intersect_points(self, x, y):
+        """
+        Every (point position, polygon position) pair where the point intersects the polygon,
+        sorted by point, then polygon.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        i, j = self.get_candidate_pairs(x, y)
+        hit = np.zeros(len(i), dtype=bool)
+        prepared = self.get_prepared_geometries()
+        # Without vectorized tests, every test is a python call, and the bands would only add more of them
+        bands = self.get_simplified_bands() if self.simplify_tolerance and has_vectorized_shapely() else None
+        order = np.argsort(j, kind='stable')
+        splits = np.flatnonzero(np.diff(j[order])) + 1
+        for group in np.split(order, splits) if len(order) else []:
+            k = j[group[0]]
+            px, py = x[i[group]], y[i[group]]
+            if bands is None:
+                hit[group] = points_intersect(prepared[k], px, py)
+                continue
+            inner, outer = bands[k]
+            inside = points_intersect(inner, px, py)
+            borderline = ~inside & points_intersect(outer, px, py)
+            inside[borderline] = points_intersect(prepared[k], px[borderline], py[borderline])
+            hit[group] = inside
+        i, j = i[hit], j[hit]
+        order = np.lexsort((j, i))
+        return i[order], j[order]
+
+    def sjoin_points(self, point_gdf):
+        """
+        The equivalent of gpd.sjoin(point_gdf, self.gdf, how="left", op="intersects") for points,
+        through the acceleration layer.
+        """
+        geometry = point_gdf.geometry
+        i, j = self.intersect_points(geometry.x.to_numpy(), geometry.y.to_numpy())
+        polygons = pd.DataFrame(self.gdf.drop(columns=self.gdf.geometry.name))
+        shared = set(point_gdf.columns) & set(polygons.columns)
+        left = point_gdf.rename(columns={c: c + "_left" for c in shared})
+        polygons = polygons.rename(columns={c: c + "_right" for c in shared})
+        polygons.insert(0, "index_right", self.gdf.index)
+
+        # Points in no polygon are kept once, with empty polygon fields
+        unmatched = np.setdiff1d(np.arange(len(point_gdf)), i)
+        rows = np.concatenate([i, unmatched])
+        right = polygons.iloc[j].reset_index(drop=True).reindex(np.arange(len(rows)))
+        right.index = left.index[rows]
+        joined = pd.concat([left.iloc[rows], right], axis=1)
+        return joined.iloc[np.argsort(rows, kind='stable')]
+
+
+def has_vectorized_shapely():
+    """Whether shapely has the vectorized functions of shapely 2"""
+    import shapely
+    return hasattr(shapely, "intersects_xy")
+
+
+def points_intersect(prepared, x, y):
+    """Test which points intersect a prepared geometry"""
+    if has_vectorized_shapely():
+        import shapely
+        shapely.prepare(prepared.context)
+        return shapely.intersects_xy(prepared.context, x, y)
+    from shapely.geometry import Point
+    return np.fromiter((prepared.intersects(Point(a, b)) for a, b in zip(x, y)), dtype=bool, count=len(x))
 
 
 class DataManager(AbstractGeoHandler):
@@ -130,10 +391,13 @@ class DataManager(AbstractGeoHandler):
 
     def __init__(self, **kwargs):
         """
-        Initialize a DataHandler.  If 'path' is passed, use that to read a GDF and initialize
-        AbstractGeoHandler.  Otherwise, look for a GDF based on the objects local and remote connections
+        Initialize a DataHandler.  If 'gdf' is passed, use it directly; if 'path' is passed, use that to read
+        a GDF and initialize AbstractGeoHandler.  Otherwise, look for a GDF based on the objects local and
+        remote connections
         """
-        if "path" in kwargs:
+        if "gdf" in kwargs:
+            gdf = kwargs["gdf"]
+        elif "path" in kwargs:
             gdf = self.read_local_data(kwargs.get("path"))
         else:
             gdf = self.get_gdf()
@@ -150,7 +414,7 @@ class DataManager(AbstractGeoHandler):
         if path is None:
             return gpd.read_file(self.get_local_path())
         else:
-            pass
+            return gpd.read_file(path)
 
     def get_local_path(self):
         """Construct a local file path"""
@@ -161,6 +425,7 @@ class DataManager(AbstractGeoHandler):
         """Look for remote data.  Requires URL construction in child class."""
         import requests
         file_path = self.get_local_path()
+        os.makedirs(self.home_dir, exist_ok=True)
         with open(file_path, "wb") as file:
             r = requests.get(self.construct_url())
             file.write(r.content)
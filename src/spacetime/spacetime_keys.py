@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+"""
+Integer spatial and space-time keys, for sorting, grouping, joining and neighbour lookups
+with plain integer operations instead of geometry.
+
+Cells are squares of a quadtree over the equidistant projection of spacetime_analytics,
+covering 2^24 metres (about 16,800km) on each side.  A cell at level L is 2^(24 - L) metres wide,
+so level 14 cells are 1024m, and level 24 cells are 1m.  Cells are keyed by the Morton (Z-order) code
+of their column and row, which interleaves their bits: nearby cells tend to have nearby keys,
+and the key of a cell's parent is the key shifted right by 2 bits.
+Keys are computed once at MAX_LEVEL, and coarsened to any other level by a shift.
+"""
+
+MAX_LEVEL = 24
+EXTENT = 2.0 ** 24
+ORIGIN = (-EXTENT / 2, -EXTENT / 2)
+
+
+def get_cell_size(level):
+    """The width of the cells at a level, in metres"""
+    return EXTENT / 2 ** level
+
+
+def _spread_bits(v):
+    """Spread the low 32 bits of v to the even bits of a 64 bit integer"""
+    v = v.astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _compact_bits(v):
+    """Gather the even bits of v into its low 32 bits; the inverse of _spread_bits"""
+    v = v.astype(np.uint64) & np.uint64(0x5555555555555555)
+    v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def morton_encode(column, row):
+    """Interleave column and row indices into Morton keys"""
+    return (_spread_bits(np.asarray(column)) | (_spread_bits(np.asarray(row)) << np.uint64(1))).astype(np.int64)
+
+
+def morton_decode(keys):
+    """Split Morton keys back into column and row indices"""
+    keys = np.asarray(keys).astype(np.uint64)
+    return _compact_bits(keys).astype(np.int64), _compact_bits(keys >> np.uint64(1)).astype(np.int64)
+
+
+def get_cell_keys(xy, level=MAX_LEVEL):
+    """
+    The keys of the cells holding projected points (n by 2, metres), at a level.
+    Points that are missing or outside the grid get -1.
+    """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    index = np.floor((xy - ORIGIN) / get_cell_size(level))
+    valid = np.isfinite(index).all(axis=1) & (index >= 0).all(axis=1) & (index < 2 ** level).all(axis=1)
+    index = np.where(valid[:, None], index, 0).astype(np.int64)
+    return np.where(valid, morton_encode(index[:, 0], index[:, 1]), -1)
+
+
+def coarsen_keys(keys, from_level, to_level):
+    """Convert keys to a coarser level, keeping -1 for missing points"""
+    if to_level > from_level:
+        raise ValueError("Keys can only be coarsened")
+    keys = np.asarray(keys)
+    return np.where(keys >= 0, keys >> (2 * (from_level - to_level)), -1)
+
+
+def get_neighbour_keys(keys, level):
+    """
+    The keys of the 3 by 3 block of cells around each cell (n by 9, the cell itself included).
+    Neighbours outside the grid, and all neighbours of missing cells, are -1.
+    """
+    column, row = morton_decode(keys)
+    offsets = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    columns = column[:, None] + offsets[:, 0]
+    rows = row[:, None] + offsets[:, 1]
+    valid = (columns >= 0) & (columns < 2 ** level) & (rows >= 0) & (rows < 2 ** level) & \
+            (np.asarray(keys) >= 0)[:, None]
+    return np.where(valid, morton_encode(np.where(valid, columns, 0), np.where(valid, rows, 0)), -1)
+
+
+def get_time_buckets(t, time_width):
+    """The bucket of each time (seconds since the epoch), time_width seconds wide"""
+    return np.floor(np.asarray(t, dtype=np.float64) / time_width).astype(np.int64)
+
+
+def get_space_time_keys(cell_keys, level, buckets):
+    """
+    Pack cell keys at a level and time buckets into one integer, ordered by time bucket, then cell.
+    Missing cells give -1.
+    """
+    buckets = np.asarray(buckets, dtype=np.int64)
+    if len(buckets) and (buckets.min() < 0 or buckets.max() >= 2 ** (63 - 2 * level)):
+        raise ValueError("Time buckets don't fit beside level {} cells; use a coarser level or wider buckets"
+                         .format(level))
+    cell_keys = np.asarray(cell_keys)
+    return np.where(cell_keys >= 0, (buckets << (2 * level)) | cell_keys, -1)
+
+
+def get_representative_xy(gdf):
+    """Projected coordinates of each feature: the point itself, or the centroid of other geometries"""
+    from src.spacetime.spacetime_analytics import get_equidistant_dataframe
+    g = get_equidistant_dataframe(gdf).geometry
+    if not (g.geom_type == "Point").all():
+        g = g.centroid
+    return np.column_stack([g.x.to_numpy(dtype=np.float64), g.y.to_numpy(dtype=np.float64)])
+
+
+def join_keys(keys, other_keys):
+    """
+    Hash join two key arrays.
+    keys may be n by k, for several keys per row (e.g. neighbours); -1 never matches.
+    :return: arrays of the matching positions in keys and other_keys
+    """
+    keys = np.asarray(keys)
+    keys = keys.reshape(len(keys), -1)
+    left = pd.DataFrame({"key": keys.ravel(), "i": np.repeat(np.arange(len(keys)), keys.shape[1])})
+    right = pd.DataFrame({"key": np.asarray(other_keys), "j": np.arange(len(other_keys))})
+    joined = left[left.key >= 0].merge(right[right.key >= 0], on="key")
+    return joined.i.to_numpy(dtype=np.intp), joined.j.to_numpy(dtype=np.intp)
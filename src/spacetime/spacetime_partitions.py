@@ -0,0 +1,205 @@
+import copy
+import os.path
+import shutil
+import tempfile
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from src.spacetime.spacetime_handlers import AbstractTimePointEvent, AbstractTimeDurationEvent
+from src.spacetime.spacetime_analytics import SpaceTimeContainment, get_epoch_seconds, \
+    get_equidistant_coordinates, space_time_neighbour_counts
+from src.spacetime.spacetime_keys import get_cell_keys, get_representative_xy
+
+
+def get_time_field(handler):
+    """The field a handler is ordered by in time; the start field for duration events"""
+    if isinstance(handler, AbstractTimeDurationEvent):
+        return handler.t_start_field
+    return handler.t_field
+
+
+class TemporalPartitions:
+    """
+    Chunked, out-of-core execution for handlers too large to hold in memory.
+    Rows are split into time-ordered partitions of width 'freq', which are pickled to 'directory'.
+    Only one partition, plus a halo of its neighbours for windowed queries, is loaded at a time,
+    so peak memory is bounded by the partition size rather than the dataset.
+
+    Partitions are handed out as shallow copies of 'template', the handler the data came from,
+    so all handler and analytic methods work on them unchanged.
+    If cell_level is given, rows are written sorted by their spatial cell key at that level
+    (see spacetime_keys), so nearby rows are stored together within each partition.
+    """
+
+    def __init__(self, template, directory=None, freq=timedelta(days=1), cell_level=None):
+        self.template = template
+        self.freq = freq
+        self.cell_level = cell_level
+        self.t_field = get_time_field(template)
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="tmp_partitions_")
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_handler(cls, handler, directory=None, freq=timedelta(days=1), cell_level=None):
+        """Partition an in-memory handler"""
+        partitions = cls(handler, directory=directory, freq=freq, cell_level=cell_level)
+        partitions.append(handler.gdf)
+        return partitions
+
+    @classmethod
+    def from_chunks(cls, template, chunks, directory=None, freq=timedelta(days=1), cell_level=None):
+        """Partition an iterable of GeoDataFrames, e.g. one per file or per remote fetch,
+        without ever holding more than one chunk in memory"""
+        partitions = cls(template, directory=directory, freq=freq, cell_level=cell_level)
+        for chunk in chunks:
+            partitions.append(chunk)
+        return partitions
+
+    def append(self, gdf):
+        """Split a GeoDataFrame by partition, and append each piece to its partition on disk"""
+        if len(gdf) == 0:
+            return
+        keys = self.get_keys(gdf[self.t_field])
+        if self.cell_level is not None:
+            order = np.argsort(get_cell_keys(get_representative_xy(gdf), self.cell_level), kind='stable')
+            gdf, keys = gdf.iloc[order], keys[order]
+        for key in np.unique(keys):
+            part_dir = self.get_partition_dir(key)
+            os.makedirs(part_dir, exist_ok=True)
+            n = len(os.listdir(part_dir))
+            gdf[keys == key].to_pickle(os.path.join(part_dir, "part-{:05d}.pkl".format(n)))
+
+    def get_keys(self, times):
+        """The partition key of each time: the start of its partition, in seconds since the epoch"""
+        width = self.freq.total_seconds()
+        return (np.floor(get_epoch_seconds(times) / width) * width).astype(np.int64)
+
+    def get_partition_dir(self, key):
+        return os.path.join(self.directory, "{:012d}".format(key))
+
+    def partitions(self):
+        """The sorted keys of all non-empty partitions"""
+        return sorted(int(i) for i in os.listdir(self.directory) if i.isdigit())
+
+    def read_partition(self, key):
+        """Read one partition into a GeoDataFrame"""
+        part_dir = self.get_partition_dir(key)
+        parts = [pd.read_pickle(os.path.join(part_dir, i)) for i in sorted(os.listdir(part_dir))]
+        return pd.concat(parts, sort=False) if len(parts) > 1 else parts[0]
+
+    def write_partition(self, key, gdf):
+        """Replace one partition on disk, removing it if it is empty"""
+        part_dir = self.get_partition_dir(key)
+        shutil.rmtree(part_dir)
+        if len(gdf) > 0:
+            os.makedirs(part_dir)
+            gdf.to_pickle(os.path.join(part_dir, "part-00000.pkl"))
+
+    def as_handler(self, gdf):
+        """Wrap a GeoDataFrame in a copy of the template handler"""
+        handler = copy.copy(self.template)
+        handler.gdf = gdf
+        return handler
+
+    def load(self, key, halo=None):
+        """
+        Load one partition as a handler.
+        If halo (a timedelta) is given, rows of the neighbouring partitions within halo of this partition
+        are included, and a boolean array marking the partition's own rows is returned alongside.
+        """
+        gdf = self.read_partition(key)
+        if halo is None:
+            return self.as_handler(gdf)
+
+        t0 = pd.Timestamp(key, unit="s")
+        t1 = t0 + self.freq
+        keys = self.partitions()
+        halo_keys = [k for k in keys if k != key and
+                     pd.Timestamp(k, unit="s") < t1 + halo and
+                     pd.Timestamp(k, unit="s") + self.freq > t0 - halo]
+        pieces = [gdf]
+        for k in halo_keys:
+            other = self.read_partition(k)
+            t = pd.to_datetime(other[self.t_field])
+            pieces.append(other[(t >= t0 - halo) & (t < t1 + halo)])
+        core = np.zeros(sum(len(i) for i in pieces), dtype=bool)
+        core[:len(gdf)] = True
+        return self.as_handler(pd.concat(pieces, sort=False)), core
+
+    def __iter__(self):
+        for key in self.partitions():
+            yield self.load(key)
+
+    def apply(self, func):
+        """Apply an in-place handler operation, like clip_spatial, to each partition in turn"""
+        for key in self.partitions():
+            handler = self.load(key)
+            func(handler)
+            self.write_partition(key, handler.gdf)
+
+    def map(self, func, halo=None):
+        """
+        Call func on each partition in turn, concatenating the results.
+        With a halo, func is called as func(handler, core) and should only return results for the core rows.
+        """
+        results = []
+        for key in self.partitions():
+            if halo is None:
+                results.append(func(self.load(key)))
+            else:
+                results.append(func(*self.load(key, halo=halo)))
+        return pd.concat(results, sort=False) if results else pd.Series()
+
+    def to_handler(self):
+        """Gather every partition back into one in-memory handler"""
+        return self.as_handler(pd.concat([self.read_partition(k) for k in self.partitions()], sort=False))
+
+    def clip_temporal(self, t0, t1):
+        """Clip to a temporal extent, partition by partition"""
+        self.apply(lambda h: h.clip_temporal(t0, t1))
+
+    def clip_spatial(self, extent):
+        """Clip to a bounding box, partition by partition"""
+        self.apply(lambda h: h.clip_spatial(extent))
+
+    def clip_by_shape(self, other_gdf):
+        """Clip by another GDF, partition by partition"""
+        self.apply(lambda h: h.clip_by_shape(other_gdf))
+
+    def cut_data_by_values(self, keys):
+        """Filter by specific values, partition by partition"""
+        self.apply(lambda h: h.cut_data_by_values(keys))
+
+    def space_time_containment(self, time_duration_handler):
+        """
+        SpaceTimeContainment.space_time_containment, partition by partition.
+        Each partition of points is only joined to the durations overlapping its time range.
+        """
+        def contain(handler):
+            t = handler.gdf[handler.t_field]
+            durations = copy.copy(time_duration_handler)
+            durations.gdf = durations.gdf[(durations.gdf[durations.t_start_field] <= t.max()) &
+                                          (durations.gdf[durations.t_end_field] >= t.min())]
+            return SpaceTimeContainment.space_time_containment(handler, durations)
+        return self.map(contain)
+
+    def space_time_neighbour_counts(self, spatial_distance, time_window):
+        """
+        SpaceTimePointStatistics.space_time_neighbour_counts, partition by partition.
+        Neighbours in adjacent partitions are found through a halo of time_window seconds.
+        """
+        if not isinstance(self.template, AbstractTimePointEvent):
+            raise TypeError("Neighbour counts need point events")
+
+        def count(handler, core):
+            xy = get_equidistant_coordinates(handler.gdf)
+            t = get_epoch_seconds(handler.gdf[handler.t_field])
+            counts = space_time_neighbour_counts(xy[core], t[core], xy, t, spatial_distance, time_window)
+            return pd.Series(counts, index=handler.gdf.index[core])
+        return self.map(count, halo=timedelta(seconds=time_window))
+
+    def remove(self):
+        """Delete the partitions from disk"""
+        shutil.rmtree(self.directory)
@@ -0,0 +1,173 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from src.spacetime.spacetime_analytics import n_nearest_in_time_window
+
+"""
+Resampling for the calibrated thresholds of run.py.
+Bootstraps the LSR/Waze associations behind the spatial and temporal thresholds (S, T),
+and runs time-shuffle permutation tests of the space-time interaction between Waze reports.
+
+Everything is computed from coordinate arrays prepared once in ThresholdResampler.
+Replicates are split across a process pool; each task gets its own seed spawned from one
+SeedSequence, so results are reproducible whatever the number of workers.
+Where processes are spawned (macOS, Windows), call these from under an `if __name__ == "__main__":` guard,
+or pass max_workers=1.
+"""
+
+# Replicates are run in blocks of this size, one block per task
+REPLICATES_PER_TASK = 50
+
+# Arrays shared with the worker processes, set once per worker by _init_worker
+_shared = {}
+
+
+def _init_worker(arrays):
+    _shared.clear()
+    _shared.update(arrays)
+
+
+def _bootstrap_task(seed, n_replicates, p):
+    """Run n_replicates bootstrap replicates against the shared arrays"""
+    rng = np.random.default_rng(seed)
+    m = len(_shared["radii"])
+    out = np.empty((n_replicates, 2))
+    for r in range(n_replicates):
+        out[r] = calibrate(_shared["radii"], _shared["counts"], _shared["owner"], p,
+                           weights=np.bincount(rng.integers(0, m, m), minlength=m))
+    return out
+
+
+def _permutation_task(seed, n_permutations, time_window):
+    """Count the space-time close pairs for n_permutations shuffles of the shared times"""
+    rng = np.random.default_rng(seed)
+    i, j, t = _shared["i"], _shared["j"], _shared["t"]
+    out = np.empty(n_permutations, dtype=np.int64)
+    for r in range(n_permutations):
+        shuffled = t[rng.permutation(len(t))]
+        out[r] = np.count_nonzero(np.abs(shuffled[i] - shuffled[j]) <= time_window)
+    return out
+
+
+def calibrate(radii, counts, owner, p, weights=None):
+    """
+    The (S, T) thresholds of run.py's main(), from per-LSR arrays:
+    S is the p quantile of the LSR radii, and T the floor of the 1-p quantile of the temporal counts
+    of the Waze reports around the LSRs with radius below S.
+    weights gives how many times each LSR is drawn, for bootstrap samples.
+    """
+    if weights is None:
+        weights = np.ones(len(radii), dtype=np.int64)
+    finite = np.isfinite(radii)
+    drawn = np.repeat(radii[finite], weights[finite])
+    if len(drawn) == 0:
+        return np.nan, np.nan
+    spatial_distance_threshold = np.quantile(drawn, p)
+    selected = np.where(radii < spatial_distance_threshold, weights, 0)
+    drawn_counts = np.repeat(counts, selected[owner])
+    if len(drawn_counts) == 0:
+        return spatial_distance_threshold, np.nan
+    return spatial_distance_threshold, math.floor(np.quantile(drawn_counts, 1 - p))
+
+
+class ThresholdResampler:
+    """
+    Bootstrap confidence intervals for the calibrated (S, T) thresholds,
+    and permutation p-values for the space-time clustering of Waze reports.
+    lsrs and waze are SpaceTimePointStatistics handlers; n, p, temporal_filter and time_window are as in run.py.
+    """
+
+    def __init__(self, lsrs, waze, n, p, temporal_filter=(-6*60*60, 1*60*60), time_window=30*60):
+        self.n = n
+        self.p = p
+        self.temporal_filter = temporal_filter
+        self.time_window = time_window
+        self.lsr_xy, self.lsr_t = lsrs.get_space_time_arrays()
+        self.waze_xy, self.waze_t = waze.get_space_time_arrays()
+        self.radii, self.counts, self.owner = self.prepare()
+
+    def prepare(self):
+        """
+        Precompute, for every LSR, the radius holding its n nearest Waze reports within the temporal filter,
+        and the temporal counts of the Waze reports inside that radius.
+        Returns the radii, the flattened counts, and the LSR each count belongs to.
+        """
+        # The filter is on Waze time - LSR time, so it flips for the LSR to Waze search
+        lo, hi = self.temporal_filter
+        distance, position = n_nearest_in_time_window(self.lsr_xy, self.lsr_t, self.waze_xy, self.waze_t,
+                                                      (-hi, -lo), self.n)
+        found = position >= 0
+        radii = np.where(found.any(axis=1), np.where(found, distance, -np.inf).max(axis=1), np.nan)
+
+        # Members are strictly inside the radius, as in main()
+        members = found & (distance < radii[:, None])
+        times = self.waze_t[np.where(found, position, 0)]
+        close = np.abs(times[:, :, None] - times[:, None, :]) < self.time_window
+        counts = (close & members[:, None, :]).sum(axis=2)
+        owner = np.repeat(np.arange(len(radii)), members.sum(axis=1))
+        return radii, counts[members], owner
+
+    def estimate(self):
+        """The (S, T) thresholds on the full sample"""
+        return calibrate(self.radii, self.counts, self.owner, self.p)
+
+    def bootstrap(self, n_replicates=1000, alpha=0.05, seed=0, max_workers=None):
+        """
+        Bootstrap the LSRs, recalibrating (S, T) on each replicate.
+        :return: dict with the estimate, the (1 - alpha) percentile confidence interval of each threshold,
+        and the replicates
+        """
+        arrays = {"radii": self.radii, "counts": self.counts, "owner": self.owner}
+        replicates = np.concatenate(self._run(_bootstrap_task, arrays, n_replicates, seed, max_workers, self.p))
+        s, t = self.estimate()
+        q = [alpha / 2, 1 - alpha / 2]
+        return {
+            "spatial_distance_threshold": s,
+            "temporal_distance_threshold": t,
+            "spatial_ci": tuple(np.nanquantile(replicates[:, 0], q)),
+            "temporal_ci": tuple(np.nanquantile(replicates[:, 1], q)),
+            "replicates": replicates
+        }
+
+    def permutation_test(self, spatial_distance=None, time_window=None, n_permutations=999, seed=0,
+                         max_workers=None):
+        """
+        Time-shuffle permutation test of space-time interaction between Waze reports.
+        The statistic is the number of report pairs within spatial_distance metres and time_window seconds;
+        shuffling times across reports breaks any space-time interaction while keeping both marginals.
+        spatial_distance defaults to the calibrated S.
+        :return: dict with the observed statistic, the permutation mean and the one-sided p-value
+        """
+        from scipy.spatial import cKDTree
+        if spatial_distance is None:
+            spatial_distance = self.estimate()[0]
+        if time_window is None:
+            time_window = self.time_window
+        # Spatially close pairs don't change under time shuffles, so find them once
+        pairs = cKDTree(self.waze_xy).query_pairs(spatial_distance, output_type='ndarray')
+        arrays = {"i": pairs[:, 0], "j": pairs[:, 1], "t": self.waze_t}
+        observed = np.count_nonzero(np.abs(self.waze_t[pairs[:, 0]] - self.waze_t[pairs[:, 1]]) <= time_window)
+        permuted = np.concatenate(self._run(_permutation_task, arrays, n_permutations, seed, max_workers,
+                                            time_window))
+        return {
+            "observed": observed,
+            "expected": permuted.mean(),
+            "p_value": (1 + np.count_nonzero(permuted >= observed)) / (1 + n_permutations),
+            "permutations": permuted
+        }
+
+    @staticmethod
+    def _run(task, arrays, n, seed, max_workers, *args):
+        """Split n replicates of task into blocks of REPLICATES_PER_TASK, each with a spawned seed.
+        Blocks don't depend on max_workers, so neither do the results.  max_workers=1 runs in this process"""
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        n_tasks = max(1, math.ceil(n / REPLICATES_PER_TASK))
+        sizes = [len(i) for i in np.array_split(np.arange(n), n_tasks)]
+        seeds = np.random.SeedSequence(seed).spawn(n_tasks)
+        if max_workers == 1:
+            _init_worker(arrays)
+            return [task(s, size, *args) for s, size in zip(seeds, sizes)]
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(arrays,)) as pool:
+            return list(pool.map(task, seeds, sizes, *[[a] * n_tasks for a in args]))
@@ -3,14 +3,14 @@ import pickle
 from urllib.parse import urlparse, parse_qs
 import datetime
 import os.path
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from src.configuration import config
 from src.spacetime.spacetime_handlers import AbstractGeoHandler, AbstractTimePointEvent
 from src.spacetime.spacetime_analytics import SpaceTimePointStatistics
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
@@ -64,13 +64,21 @@ WAZE_REGISTRY = [
 ]
 
 
-def get_waze_from_google_sheets(spreadsheet_id='1yeIgD2Dzb9TumUGLfixaVkdU_wU_lIB8_altNzVpxmY',
-                                range_names=('FormResponses!Q6:Q', 'FormResponses!T6:T')):
+# Waze rows start on this row of each sheet, with report URLs in column Q and times in column T
+FIRST_SHEET_ROW = 6
+SHEET_RANGES = ('FormResponses!Q{start}:Q', 'FormResponses!T{start}:T')
+
+
+def get_google_credentials():
     """
-    Fetch the Waze data from Google Sheets.
+    Load, refresh or create the Google OAuth credentials, cached in token.pickle.
     This function follows closely with the example found here:
     - https://developers.google.com/sheets/api/quickstart/python
     """
+    # The Google client libraries are slow to import, and only needed when fetching
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+
     creds = None
     if os.path.exists('token.pickle'):
         with open('token.pickle', 'rb') as token:
@@ -89,14 +97,40 @@ def get_waze_from_google_sheets(spreadsheet_id='1yeIgD2Dzb9TumUGLfixaVkdU_wU_lIB
                                           open_browser=True)
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
+    return creds
+
 
-    service = build('sheets', 'v4', credentials=creds)
+def get_sheets_service(creds=None):
+    """Build a Google Sheets service.
+    The underlying http client is not thread safe, so build one service per thread."""
+    from googleapiclient.discovery import build
+    if creds is None:
+        creds = get_google_credentials()
+    return build('sheets', 'v4', credentials=creds)
+
+
+def get_waze_from_google_sheets(spreadsheet_id='1yeIgD2Dzb9TumUGLfixaVkdU_wU_lIB8_altNzVpxmY',
+                                range_names=('FormResponses!Q6:Q', 'FormResponses!T6:T'),
+                                service=None):
+    """
+    Fetch the Waze data from Google Sheets.
+    Pass a service to reuse an existing connection, or a fake service for offline testing.
+    """
+    if service is None:
+        service = get_sheets_service()
     sheet = service.spreadsheets()
     result = sheet.values().batchGet(spreadsheetId=spreadsheet_id,
                                      ranges=range_names).execute()
     return result
 
 
+# The time patterns found in the Waze sheets, in the order they are tried
+TIME_PATTERNS = ['%m/%d/%Y %H:%M:%S',
+                 '%m/%d/%y %H:%M:%S',
+                 '%m/%d/%Y %H:%M',
+                 '%m/%d/%y %H:%M']
+
+
 def parse_url_list(unparsed_list):
     """Parse URLs returned as a column from the Waze Sheets"""
     url_list = []
@@ -113,10 +147,7 @@ def parse_time_list(unparsed_list):
     Unfortunately the patterns aren't consistent, and currently we're handling that by checking for
     multiple time patterns."""
     time_list = []
-    patterns = ['%m/%d/%Y %H:%M:%S',
-                '%m/%d/%y %H:%M:%S',
-                '%m/%d/%Y %H:%M',
-                '%m/%d/%y %H:%M']
+    patterns = TIME_PATTERNS
     for timestring in unparsed_list:
         if len(timestring) > 0:
             t = "NONE"
@@ -149,6 +180,7 @@ def parse_raw_waze_data(data):
     Parse and format the raw values returned by Waze.
     Unfortunately the data is not well formatted.  The most consistent data comes from the URLs supplied,
     hence we create x,y points by parsing those URLs.
+    For large sheets use parse_raw_waze_batch.
     """
     return_buffer = []
     x = [col['values'] for col in data['valueRanges']]
@@ -171,17 +203,179 @@ def parse_raw_waze_data(data):
     return return_buffer
 
 
-def fetch_all_waze_to_local(root):
-    """Fetch all Waze VEOC sheets to local file system."""
+def parse_raw_waze_batch(data, as_geodataframe=False):
+    """
+    Vectorized version of parse_raw_waze_data, for large sheets.
+    lat/lon are extracted from the URL column with vectorized string extraction,
+    and joined to the times parsed against TIME_PATTERNS.
+    Rows without a parsable lat/lon, or with a non-empty time that matches no pattern, are rejected.
+    Empty times are kept as 0, as in parse_time_list.
+    Returns a (DataFrame of float lat, lon and int time, number of rejected rows) tuple,
+    or a GeoDataFrame of points in place of the DataFrame if as_geodataframe.
+    """
+    urls, times = [pd.Series(col.get('values', []), dtype=object).str[0] for col in data['valueRanges'][:2]]
+    n_rows = max(len(urls), len(times))
+    urls = urls.reindex(range(n_rows))
+    times = times.reindex(range(n_rows))
+
+    coordinates = pd.DataFrame({
+        key: pd.to_numeric(urls.str.extract(r'[?&]' + key + r'=([-+]?[0-9]*\.?[0-9]+)', expand=False),
+                           errors='coerce')
+        for key in ("lat", "lon")
+    })
+
+    has_time = times.notnull() & (times.str.len() > 0)
+    parsed = pd.Series(pd.NaT, index=times.index, dtype="datetime64[ns]")
+    for pattern in TIME_PATTERNS:
+        missing = has_time & parsed.isnull()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(times[missing], format=pattern, errors='coerce')
+
+    # Encode as the YYYYmmddHHMMSS integers written by parse_time_list
+    fields = [getattr(parsed.dt, f).astype(np.float64) for f in ("year", "month", "day", "hour", "minute", "second")]
+    numeric_time = sum(field * 10**(10 - 2*i) for i, field in enumerate(fields))
+    numeric_time = numeric_time.fillna(0).astype(np.int64)
+
+    valid = coordinates["lat"].notnull() & coordinates["lon"].notnull() & ~(has_time & parsed.isnull())
+    frame = pd.DataFrame({
+        "lat": coordinates["lat"][valid].to_numpy(),
+        "lon": coordinates["lon"][valid].to_numpy(),
+        "time": numeric_time[valid].to_numpy()
+    })
+    rejected = int(n_rows - valid.sum())
+
+    if as_geodataframe:
+        frame = gpd.GeoDataFrame(
+            frame.drop(columns=['lon', 'lat']),
+            crs={'init': 'epsg:4326'},
+            geometry=gpd.points_from_xy(frame.lon, frame.lat)
+        )
+    return frame, rejected
+
+
+def fetch_all_waze_to_local(root, incremental=False, service_factory=None, max_workers=4):
+    """Fetch all Waze VEOC sheets to local file system.
+    If incremental, only rows added since the last sync are fetched, see sync_waze_to_local."""
+    if incremental:
+        return sync_waze_to_local(root, service_factory=service_factory, max_workers=max_workers)
+    os.makedirs(root, exist_ok=True)
     for event in WAZE_REGISTRY:
         file_name = event["event"] + ".txt"
         waze_path = os.path.join(root, file_name)
-        with open(waze_path, "w") as out_file:
-            out_file.write(",".join(["lat", "lon", "time", "event"]) + "\n")
-            x = get_waze_from_google_sheets(spreadsheet_id=event["spreadsheet_id"])
-            x = parse_raw_waze_data(x)
-            for i in x:
-                out_file.write(",".join([i["lat"], i["lon"], i["time"], event["event"]])+"\n")
+        x = get_waze_from_google_sheets(spreadsheet_id=event["spreadsheet_id"])
+        x, rejected = parse_raw_waze_batch(x)
+        x["event"] = event["event"]
+        x.to_csv(waze_path, columns=["lat", "lon", "time", "event"], index=False)
+        print("{}: {} rows, {} rejected".format(event["event"], len(x), rejected))
+
+
+class WazeColumnStore:
+    """
+    Columnar local store for parsed Waze reports.
+    Each event is a directory of numbered .npz parts, one per sync, holding the lat, lon and time columns.
+    The last synced spreadsheet row is recorded alongside, in state.json.
+    """
+
+    columns = ("lat", "lon", "time")
+    state_file: str = "state.json"
+
+    def __init__(self, root):
+        self.root = root
+
+    def event_dir(self, event_name):
+        """Directory holding the parts of an event"""
+        return os.path.join(self.root, event_name.replace(" ", "_"))
+
+    def get_state_path(self, event_name):
+        """Path of an event's sync state, which changes on every sync that adds rows"""
+        return os.path.join(self.event_dir(event_name), self.state_file)
+
+    def get_state(self, event_name):
+        """Get the sync state of an event, or None if it has never been synced"""
+        path = self.get_state_path(event_name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def get_last_row(self, event_name):
+        """Get the last synced spreadsheet row of an event"""
+        state = self.get_state(event_name)
+        if state is None:
+            return FIRST_SHEET_ROW - 1
+        return state["last_row"]
+
+    def append(self, event_name, columns, last_row):
+        """Append a part to an event and record the last synced row.
+        The part is written before the state, so an interrupted sync is simply fetched again."""
+        directory = self.event_dir(event_name)
+        os.makedirs(directory, exist_ok=True)
+        state = self.get_state(event_name) or {"parts": 0}
+        np.savez(os.path.join(directory, "part-{:05d}.npz".format(state["parts"])),
+                 **{c: columns[c] for c in self.columns})
+        state["parts"] += 1
+        state["last_row"] = last_row
+        tmp = os.path.join(directory, self.state_file + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(directory, self.state_file))
+
+    def read(self, event_name):
+        """Read all parts of an event into a DataFrame"""
+        state = self.get_state(event_name)
+        if state is None:
+            return pd.DataFrame({c: [] for c in self.columns + ("event",)})
+        directory = self.event_dir(event_name)
+        parts = []
+        for i in range(state["parts"]):
+            with np.load(os.path.join(directory, "part-{:05d}.npz".format(i))) as part:
+                parts.append({c: part[c] for c in self.columns})
+        df = pd.DataFrame({c: np.concatenate([p[c] for p in parts]) for c in self.columns})
+        df["event"] = event_name
+        return df
+
+
+def sync_waze_event(store, event, service):
+    """Fetch only the rows added to an event's sheet since its last sync, and append them to the store.
+    Rows at the end of the sheet whose time is still blank are being filled in, and are left for the next sync.
+    Returns the number of new rows."""
+    start = store.get_last_row(event["event"]) + 1
+    data = get_waze_from_google_sheets(spreadsheet_id=event["spreadsheet_id"],
+                                       range_names=[r.format(start=start) for r in SHEET_RANGES],
+                                       service=service)
+    value_ranges = data.get("valueRanges", [])
+    # Trailing empty cells are not returned, so rows past the end of the time column have blank times too
+    times = value_ranges[1].get("values", []) if len(value_ranges) > 1 else []
+    n_rows = max([i + 1 for i, cell in enumerate(times) if len(cell) > 0 and cell[0]] + [0])
+    if n_rows == 0:
+        return 0
+    data = {"valueRanges": [dict(col, values=col.get("values", [])[:n_rows]) for col in value_ranges]}
+    parsed, _ = parse_raw_waze_batch(data)
+    store.append(event["event"], {c: parsed[c].to_numpy() for c in store.columns}, start + n_rows - 1)
+    return n_rows
+
+
+def sync_waze_to_local(root, registry=WAZE_REGISTRY, service_factory=None, max_workers=4):
+    """
+    Incrementally sync the Waze VEOC sheets to a WazeColumnStore at root.
+    Sheets are fetched concurrently.  service_factory is called once per sheet and should return
+    a Sheets service; by default it builds an authorized Google service.
+    Returns a dict of event name to the number of new rows.
+    """
+    store = WazeColumnStore(root)
+    if service_factory is None:
+        # Authorize once, before the worker threads start
+        creds = get_google_credentials()
+
+        def service_factory():
+            return get_sheets_service(creds)
+
+    def sync(event):
+        return event["event"], sync_waze_event(store, event, service_factory())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(pool.map(sync, registry))
 
 
 class WazeHandler(AbstractGeoHandler, AbstractTimePointEvent, SpaceTimePointStatistics):
@@ -189,20 +383,25 @@ class WazeHandler(AbstractGeoHandler, AbstractTimePointEvent, SpaceTimePointStat
     t_field: str = "time"
     home_dir: str = config.waze
 
-    def __init__(self, event_name):
+    def __init__(self, event_name, store=None):
+        """Load an event's reports from the .txt export in home_dir, or from a WazeColumnStore
+        kept up to date with sync_waze_to_local"""
         self.event_name = event_name
+        self.store = store
         AbstractGeoHandler.__init__(self, gdf=self.get_gdf())
 
     def get_gdf(self):
-        """Get the Waze GDF from the .txt files pulled from Google Sheets"""
-        from shapely.geometry import Point
-        csv = os.path.join(self.home_dir, "waze_" + self.event_name + ".txt")
-        df = pd.read_csv(csv)
+        """Get the Waze GDF from the .txt files pulled from Google Sheets, or from the column store"""
+        if self.store is not None:
+            df = self.store.read(self.event_name)
+        else:
+            csv = os.path.join(self.home_dir, "waze_" + self.event_name + ".txt")
+            df = pd.read_csv(csv)
         print(df)
         gdf = gpd.GeoDataFrame(
             df.drop(columns=['lon', 'lat']),
             crs={'init': 'epsg:4326'},
-            geometry=[Point(xy) for xy in zip(df.lon, df.lat)]
+            geometry=gpd.points_from_xy(df.lon, df.lat)
         )
         gdf["time"] = gdf["time"]//100
         return gdf
@@ -0,0 +1,73 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+from src.configuration import Extent
+from src.spacetime.spacetime_handlers import AbstractGeoHandler, AbstractTimePointEvent
+
+
+class Points(AbstractGeoHandler, AbstractTimePointEvent):
+    t_field = "time"
+
+
+@pytest.fixture
+def extent():
+    return Extent(temporal=(datetime(2017, 8, 25), datetime(2017, 8, 28)),
+                  spatial=AbstractGeoHandler(gdf=gpd.GeoDataFrame(geometry=[box(-96, 29, -95, 30)],
+                                                                  crs="EPSG:4326")))
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    lon, lat = rng.uniform(-96.5, -94.5, 400), rng.uniform(28.5, 30.5, 400)
+    time = pd.Timestamp("2017-08-24") + pd.to_timedelta(rng.random(400) * 5 * 86400, unit="s")
+    return Points(gpd.GeoDataFrame({"time": time}, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326"))
+
+
+@pytest.fixture
+def calls(extent, monkeypatch):
+    """Counts the temporal and spatial mask computations of the extent"""
+    counts = {"temporal": 0, "spatial": 0}
+    for kind in counts:
+        compute = getattr(extent, "get_{}_mask".format(kind))
+
+        def counted(*args, kind=kind, compute=compute, **kwargs):
+            counts[kind] += 1
+            return compute(*args, **kwargs)
+        monkeypatch.setattr(extent, "get_{}_mask".format(kind), counted)
+    return counts
+
+
+def test_apply(extent, points):
+    gdf = points.gdf
+    expected = gdf[(gdf.time > "2017-08-25") & (gdf.time < "2017-08-28") & gdf.geometry.within(box(-96, 29, -95, 30))]
+    extent.apply(points)
+    assert list(points.gdf.index) == list(expected.index)
+
+
+def test_get_mask_is_memoized(extent, points, calls):
+    first = extent.get_mask(points)
+    assert extent.get_mask(points) is first
+    assert calls == {"temporal": 1, "spatial": 1}
+    # Until the gdf changes
+    points.gdf = points.gdf.iloc[:200]
+    extent.get_mask(points)
+    assert calls == {"temporal": 2, "spatial": 2}
+
+
+def test_apply_again_does_not_recompute(extent, points, calls):
+    extent.apply(points)
+    assert calls == {"temporal": 1, "spatial": 1}
+    clipped = points.gdf
+    bounds = points.get_feature_bounds()
+
+    extent.apply(points)
+    extent.apply(points, spatial=False)
+    assert extent.get_mask(points).all()
+    assert calls == {"temporal": 1, "spatial": 1}
+    # The handler and its caches are left as they are
+    assert points.gdf is clipped
+    assert points.get_feature_bounds() is bounds
@@ -0,0 +1,118 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from src.export import RS, ReportWriter, virtual_reports
+from src.spacetime.spacetime_handlers import AbstractGeoHandler, AbstractTimePointEvent
+from src.spacetime.spacetime_analytics import SpaceTimePointStatistics
+
+
+class Points(AbstractGeoHandler, AbstractTimePointEvent, SpaceTimePointStatistics):
+    t_field = "time"
+
+
+def reports(n, start=0):
+    """n reports in web mercator, a kilometre apart"""
+    x, y = -10620000 + 1000 * np.arange(start, start + n), np.full(n, 3480000.0)
+    return gpd.GeoDataFrame({"id": np.arange(start, start + n), "score": np.linspace(0, 1, n)},
+                            geometry=gpd.points_from_xy(x, y), crs="EPSG:3857")
+
+
+def test_csv_append(tmp_path):
+    path = str(tmp_path / "out" / "reports.csv")
+    gdf = reports(5)
+    with ReportWriter(path, chunk_size=2) as writer:
+        writer.write(gdf)
+    # Appended rows are lined up with the existing header, whatever their column order
+    with ReportWriter(path, append=True) as writer:
+        writer.write(reports(3, start=5)[["geometry", "score", "id"]])
+    written = pd.read_csv(path)
+    assert list(written.columns) == ["id", "score", "lon", "lat"]
+    assert list(written.id) == list(range(8))
+    expected = gdf.to_crs(epsg=4326).geometry
+    assert written.lon.iloc[:5].to_numpy() == pytest.approx(expected.x.to_numpy())
+    assert written.lat.iloc[:5].to_numpy() == pytest.approx(expected.y.to_numpy())
+
+    # Without append, the file is replaced
+    with ReportWriter(path) as writer:
+        writer.write(reports(1))
+    assert len(pd.read_csv(path)) == 1
+
+
+@pytest.mark.parametrize("ext, prefix", [(".geojsonl", ""), (".geojsons", RS)])
+def test_geojson_lines(tmp_path, ext, prefix):
+    path = str(tmp_path / ("reports" + ext))
+    with ReportWriter(path, chunk_size=2) as writer:
+        writer.write(reports(3))
+    with ReportWriter(path, append=True) as writer:
+        writer.write(reports(2, start=3))
+    with open(path, newline="") as f:
+        lines = f.read().split("\n")
+    assert lines.pop() == ""
+    assert len(lines) == 5
+    for i, line in enumerate(lines):
+        assert line.startswith(prefix) and RS not in line[len(prefix):]
+        feature = json.loads(line[len(prefix):])
+        assert feature["properties"]["id"] == i
+        lon, lat = feature["geometry"]["coordinates"]
+        assert -96 < lon < -95 and 29 < lat < 31
+
+
+def test_parquet_append(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "reports.parquet")
+    with ReportWriter(path, chunk_size=2) as writer:
+        writer.write(reports(5))
+    assert sorted(os.listdir(path)) == ["part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+    with ReportWriter(path, append=True) as writer:
+        writer.write(reports(1, start=5))
+    table = pq.read_table(path)
+    assert sorted(table.column("id").to_pylist()) == list(range(6))
+    geo = json.loads(table.schema.metadata[b"geo"])
+    assert geo["columns"]["geometry"]["encoding"] == "WKB"
+
+    with ReportWriter(path) as writer:
+        writer.write(reports(1))
+    assert os.listdir(path) == ["part-00000.parquet"]
+
+
+def test_chunks_are_reprojected_one_at_a_time(tmp_path, monkeypatch):
+    sizes = []
+    to_crs = gpd.GeoDataFrame.to_crs
+
+    def counted(self, *args, **kwargs):
+        sizes.append(len(self))
+        return to_crs(self, *args, **kwargs)
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_crs", counted)
+    with ReportWriter(str(tmp_path / "reports.geojsonl"), chunk_size=2) as writer:
+        writer.write(reports(5))
+    assert sizes == [2, 2, 1]
+
+
+def test_virtual_reports(tmp_path):
+    # Three groups of reports; those of a group are within 100m and 10 minutes of each other
+    lon = np.repeat([-95.40, -95.30, -95.20], [3, 1, 2]) + np.array([0, 0.0005, 0.001, 0, 0, 0.0005])
+    time = pd.Timestamp("2017-08-27 12:00") + pd.to_timedelta([5, 0, 10, 0, 0, 3], unit="m")
+    gdf = gpd.GeoDataFrame({"time": time}, geometry=gpd.points_from_xy(lon, np.full(6, 29.8)),
+                           index=[10, 11, 12, 13, 14, 15], crs="EPSG:4326")
+    handler = Points(gdf)
+    # Report 13 didn't validate
+    support = pd.Series([2, 1, 1, 3, 1], index=[10, 11, 12, 14, 15])
+    nearest = pd.Series([100.0, 50.0, 20.0], index=[11, 14, 15])
+
+    chunks = list(virtual_reports(handler, support, nearest, 200, 1200, chunk_size=1))
+    assert [len(i) for i in chunks] == [1, 1]
+    out = pd.concat(chunks)
+    # The earliest report of each group stands for it
+    assert list(out.index) == [11, 14]
+    assert list(out.duplicates) == [3, 2]
+    assert list(out.support) == [1, 3]
+    assert list(out.nearest_lsr_distance) == [100.0, 50.0]
+    assert out.crs == handler.gdf.crs
+
+    path = str(tmp_path / "virtual_reports.csv")
+    with ReportWriter(path) as writer:
+        writer.write_all(virtual_reports(handler, support, nearest, 200, 1200, chunk_size=1))
+    assert list(pd.read_csv(path).duplicates) == [3, 2]
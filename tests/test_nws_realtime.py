@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from src.nws_realtime import IEMPoller, default_feeds
+
+NOW = datetime(2017, 8, 27, 13)
+
+
+def lsr(i, valid=None, typ="F"):
+    lon = -95 + i * 0.01
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, 30.0]},
+            "properties": {"product_id": "P{}".format(i), "valid": valid or "2017-08-27T12:{:02d}:00".format(i),
+                           "lat": 30.0, "lon": lon, "typetext": "FLASH FLOOD", "type": typ}}
+
+
+def warning(i):
+    ring = [[-95.2, 29.8], [-94.8, 29.8], [-94.8, 30.2], [-95.2, 30.2], [-95.2, 29.8]]
+    return {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {"product_id": "W{}".format(i), "wfo": "HGX", "phenomena": "FF", "significance": "W",
+                           "eventid": i, "issue": "2017-08-27T10:00:00", "expire": "2017-08-27T16:00:00"}}
+
+
+class FakeIEM:
+    """A local IEM serving lsr.php and sbw.php, answering 304 when the client has the current ETag"""
+
+    def __init__(self):
+        self.features = {"lsr.php": [], "sbw.php": []}
+        self.etags = {"lsr.php": "lsr-1", "sbw.php": "sbw-1"}
+        self.requests = []
+        iem = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                endpoint = self.path.split("?")[0].rsplit("/", 1)[-1]
+                iem.requests.append((endpoint, self.headers.get("If-None-Match")))
+                if self.headers.get("If-None-Match") == iem.etags[endpoint]:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = json.dumps({"type": "FeatureCollection", "features": iem.features[endpoint]}).encode()
+                self.send_response(200)
+                self.send_header("ETag", iem.etags[endpoint])
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:{}/geojson/".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def iem():
+    server = FakeIEM()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def poller(iem):
+    return IEMPoller(default_feeds(), interval=0, base_url=iem.base_url, timeout=5, now=lambda: NOW)
+
+
+def test_poll_once(iem, poller):
+    lsrs, warnings = poller.feeds
+    iem.features["lsr.php"] = [lsr(i) for i in range(5)] + [lsr(9, typ="H")]
+    iem.features["sbw.php"] = [warning(1)]
+    assert asyncio.run(poller.poll_once()) == [5, 1]
+    assert lsrs.handler.get_space_time_arrays()[0].shape == (5, 2)
+    assert warnings.handler.gdf.issue.iloc[0] == datetime(2017, 8, 27, 10)
+
+    # Unchanged feeds answer 304 to the conditional requests
+    iem.requests.clear()
+    assert asyncio.run(poller.poll_once()) == [0, 0]
+    assert sorted(iem.requests) == [("lsr.php", "lsr-1"), ("sbw.php", "sbw-1")]
+
+    # Events already seen are dropped, and new ones are appended with fresh index labels
+    iem.features["lsr.php"] = [lsr(i) for i in range(8)]
+    iem.etags["lsr.php"] = "lsr-2"
+    assert asyncio.run(poller.poll_once()) == [3, 0]
+    assert len(lsrs.handler.gdf) == 8
+    assert lsrs.handler.gdf.index.is_unique
+    assert lsrs.handler.get_space_time_arrays()[0].shape == (8, 2)
+
+
+def test_failed_poll_is_retried(iem, poller):
+    lsrs = poller.feeds[0]
+    iem.features["lsr.php"] = [lsr(1, valid="2017-08-27T12:01:00Z")]
+    counts = asyncio.run(poller.poll_once())
+    assert isinstance(counts[0], ValueError)
+    assert lsrs.etag is None and not lsrs.seen
+
+    # The next poll isn't conditional, so the events come back once they can be prepped
+    iem.features["lsr.php"] = [lsr(1)]
+    iem.requests.clear()
+    assert asyncio.run(poller.poll_once())[0] == 1
+    assert ("lsr.php", None) in iem.requests
+    assert lsrs.etag == "lsr-1"
+
+
+def test_seen_ids_are_forgotten_after_the_lookback(iem, poller):
+    lsrs, warnings = poller.feeds
+    iem.features["lsr.php"] = [lsr(i) for i in range(3)]
+    iem.features["sbw.php"] = [warning(1)]
+    asyncio.run(poller.poll_once())
+    assert len(lsrs.seen) == 3 and len(warnings.seen) == 1
+
+    # Six hours on, the reports are older than the window, but the warning hasn't expired before it
+    poller.now = lambda: datetime(2017, 8, 27, 18, 30)
+    iem.features["lsr.php"] = [lsr(5, valid="2017-08-27T18:00:00")]
+    iem.etags = {"lsr.php": "lsr-2", "sbw.php": "sbw-2"}
+    assert asyncio.run(poller.poll_once()) == [1, 0]
+    assert [i.split("|")[0] for i in lsrs.seen] == ["P5"]
+    assert len(warnings.seen) == 1
+
+    poller.now = lambda: datetime(2017, 8, 27, 22, 30)
+    iem.features["sbw.php"] = []
+    iem.etags["sbw.php"] = "sbw-3"
+    asyncio.run(poller.poll_once())
+    assert not warnings.seen
@@ -0,0 +1,100 @@
+import gc
+import os
+import numpy as np
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point, box
+from src import raster_manager
+from src.raster_manager import RasterHandler
+
+rasterio = pytest.importorskip("rasterio")
+
+HEIGHT, WIDTH = 20, 30
+NODATA = -9999
+
+
+@pytest.fixture
+def geotiff(tmp_path):
+    """
+    A synthetic 20 by 30 GeoTIFF of 1m cells, from (0, 20) at the top left to (30, 0),
+    where cell (row, col) holds 100 * row + col, except for a no data cell at (0, 0).
+    """
+    from rasterio.transform import from_origin
+    values = (100 * np.arange(HEIGHT)[:, None] + np.arange(WIDTH)[None, :]).astype("float32")
+    values[0, 0] = NODATA
+    path = str(tmp_path / "synthetic.tif")
+    with rasterio.open(path, "w", driver="GTiff", height=HEIGHT, width=WIDTH, count=1, dtype="float32",
+                       crs="EPSG:3857", transform=from_origin(0, HEIGHT, 1, 1), nodata=NODATA) as dst:
+        dst.write(values, 1)
+    expected = values.astype(np.float64)
+    expected[0, 0] = np.nan
+    return path, expected
+
+
+@pytest.fixture(params=["ram", "memmap"])
+def raster(request, geotiff, tmp_path, monkeypatch):
+    """The GeoTIFF read into RAM, or into memory-mapped files filled a few rows at a time"""
+    path, _ = geotiff
+    if request.param == "memmap":
+        monkeypatch.setattr(raster_manager, "READ_BLOCK_CELLS", 2 * WIDTH)
+        handler = RasterHandler(name="synthetic", in_file=path, memmap_threshold=10, tmp_dir=str(tmp_path))
+    else:
+        handler = RasterHandler(name="synthetic", in_file=path)
+    yield handler
+    handler.close()
+
+
+def box_cells(values, minx, miny, maxx, maxy):
+    """The cells of a box aligned to the grid"""
+    return values[HEIGHT - maxy:HEIGHT - miny, minx:maxx]
+
+
+def test_read(raster, geotiff):
+    _, expected = geotiff
+    np.testing.assert_array_equal(raster.read(), expected)
+
+
+def test_zonal_statistics_with_overlapping_polygons(raster, geotiff):
+    _, expected = geotiff
+    bounds = [(0, 10, 10, 20), (5, 5, 15, 15), (8, 8, 12, 18), (20, 0, 30, 5)]
+    polygons = gpd.GeoDataFrame(geometry=[box(*b) for b in bounds] + [box(100, 100, 110, 110)],
+                                index=list("abcde"), crs="EPSG:3857")
+    stats = raster.zonal_statistics(polygons)
+
+    assert list(stats.index) == list("abcde")
+    for label, b in zip("abcd", bounds):
+        cells = box_cells(expected, *b)
+        row = stats.loc[label]
+        assert row["count"] == np.count_nonzero(~np.isnan(cells))
+        assert row["sum"] == pytest.approx(np.nansum(cells))
+        assert row["mean"] == pytest.approx(np.nanmean(cells))
+        assert row["std"] == pytest.approx(np.nanstd(cells))
+        assert row["min"] == np.nanmin(cells)
+        assert row["max"] == np.nanmax(cells)
+    # Off the raster
+    assert stats.loc["e", "count"] == 0
+    assert stats.loc["e", ["sum", "mean", "std", "min", "max"]].isnull().all()
+
+
+def test_sample_points(raster):
+    points = gpd.GeoDataFrame(geometry=[Point(2.5, 17.5), Point(29.9, 0.1), Point(0.5, 19.5), Point(-1, 5)],
+                              crs="EPSG:3857")
+    sampled = raster.sample_points(points)
+    assert sampled.name == "synthetic"
+    assert sampled.iloc[0] == 202
+    assert sampled.iloc[1] == 1929
+    # No data, and off the raster
+    assert sampled.iloc[2:].isnull().all()
+
+
+def test_memmap_files_are_removed(geotiff, tmp_path):
+    path, expected = geotiff
+    handler = RasterHandler(in_file=path, memmap_threshold=10, tmp_dir=str(tmp_path))
+    values = handler.read()
+    assert isinstance(values, np.memmap)
+    assert any(i.startswith("tmp_") for i in os.listdir(str(tmp_path)))
+    np.testing.assert_array_equal(values, expected)
+    del values
+    gc.collect()
+    handler.close()
+    assert not any(i.startswith("tmp_") for i in os.listdir(str(tmp_path)))
@@ -0,0 +1,127 @@
+import json
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+from src.configuration import Extent
+from src.nws import LocalStormReportHandler, get_fetched_paths, iterative_fetch
+from src.session import AnalysisSession
+from src.spacetime.spacetime_handlers import AbstractGeoHandler, AbstractTimePointEvent
+from src.spacetime.spacetime_analytics import SpaceTimePointStatistics
+
+
+class Points(AbstractGeoHandler, AbstractTimePointEvent, SpaceTimePointStatistics):
+    t_field = "time"
+
+
+def make_extent(maxx=-95):
+    return Extent(temporal=(datetime(2017, 8, 27), datetime(2017, 8, 28)),
+                  spatial=AbstractGeoHandler(gdf=gpd.GeoDataFrame(geometry=[box(-96, 29, maxx, 30)],
+                                                                  crs="EPSG:4326")))
+
+
+@pytest.fixture
+def waze_file(tmp_path):
+    path = str(tmp_path / "waze.csv")
+    rng = np.random.default_rng(0)
+    time = pd.Timestamp("2017-08-27") + pd.to_timedelta(rng.integers(0, 86400, 50), unit="s")
+    pd.DataFrame({"lon": rng.uniform(-96, -95, 50), "lat": rng.uniform(29, 30, 50), "time": time}) \
+        .to_csv(path, index=False)
+    return path
+
+
+def build_from(path, extent):
+    """A session of the points in a CSV, counting the builds"""
+    def build():
+        build.calls += 1
+        df = pd.read_csv(path, parse_dates=["time"])
+        points = Points(gpd.GeoDataFrame(df[["time"]], geometry=gpd.points_from_xy(df.lon, df.lat),
+                                         crs="EPSG:4326"))
+        session = AnalysisSession("test", extent=extent, inputs=[path])
+        session.add_handler("points", points)
+        session.set_artifact("times", points.get_space_time_arrays()[1])
+        session.set_artifact("counts", pd.Series([1, 2], index=["a", "b"]))
+        session.set_artifact("thresholds", [[1, 0.5, 300.0, 1800.0]])
+        return session
+    build.calls = 0
+    return build
+
+
+def test_round_trip(waze_file, tmp_path):
+    directory = str(tmp_path / "session")
+    extent = make_extent()
+    build = build_from(waze_file, extent)
+    assert AnalysisSession.is_stale(directory)
+
+    built = AnalysisSession.load_or_build(directory, build, extent=extent)
+    assert build.calls == 1
+    assert not AnalysisSession.is_stale(directory, extent=extent)
+
+    loaded = AnalysisSession.load_or_build(directory, build, extent=extent)
+    assert build.calls == 1
+    points = loaded["points"]
+    pd.testing.assert_frame_equal(pd.DataFrame(points.gdf), pd.DataFrame(built["points"].gdf))
+    # The projected arrays come back with the handler, and aren't recomputed
+    assert "space_time_arrays" in points._caches
+    np.testing.assert_array_equal(points.get_space_time_arrays()[0], built["points"].get_space_time_arrays()[0])
+    np.testing.assert_array_equal(loaded.get_artifact("times"), built.get_artifact("times"))
+    pd.testing.assert_series_equal(loaded.get_artifact("counts"), built.get_artifact("counts"))
+    assert loaded.get_artifact("thresholds") == [[1, 0.5, 300.0, 1800.0]]
+    assert loaded.extent.temporal == extent.temporal
+
+
+def test_changed_inputs_rebuild(waze_file, tmp_path):
+    directory = str(tmp_path / "session")
+    extent = make_extent()
+    build = build_from(waze_file, extent)
+    AnalysisSession.load_or_build(directory, build, extent=extent)
+
+    # Rewriting a file with the same contents keeps the session
+    with open(waze_file) as f:
+        contents = f.read()
+    with open(waze_file, "w") as f:
+        f.write(contents)
+    os.utime(waze_file, ns=(0, 0))
+    assert not AnalysisSession.is_stale(directory)
+
+    # Changed contents don't
+    with open(waze_file, "a") as f:
+        f.write("-95.5,29.5,2017-08-27 12:00:00\n")
+    assert AnalysisSession.get_stale_inputs(directory) == [os.path.abspath(waze_file)]
+    with pytest.raises(ValueError):
+        AnalysisSession.load(directory)
+    session = AnalysisSession.load_or_build(directory, build, extent=extent)
+    assert build.calls == 2
+    assert len(session["points"].gdf) == 51
+    assert not AnalysisSession.is_stale(directory)
+
+    # Nor does another extent
+    assert AnalysisSession.is_stale(directory, extent=make_extent(maxx=-94))
+    AnalysisSession.load_or_build(directory, build, extent=make_extent(maxx=-94))
+    assert build.calls == 3
+
+
+def lsr_file(path, t):
+    features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [-95.5, 29.5]},
+                 "properties": {"valid": t.strftime("%Y-%m-%dT%H:%M:%S"), "type": "F"}}]
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def test_fetched_paths_are_the_files_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(LocalStormReportHandler, "home_dir", str(tmp_path))
+    extent = make_extent()
+    paths = get_fetched_paths(extent, LocalStormReportHandler)
+    assert len(paths) == 4
+    assert not any(os.path.exists(i) for i in paths)
+    for i, path in enumerate(paths):
+        lsr_file(path, datetime(2017, 8, 27, 7 * i))
+
+    # iterative_fetch reads every one of them, so none is fetched
+    def fetch(self):
+        raise AssertionError("fetched {}".format(self.get_local_path()))
+    monkeypatch.setattr(LocalStormReportHandler, "get_remote_data", fetch)
+    assert len(iterative_fetch(extent, LocalStormReportHandler).gdf) == 4
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+from src.spacetime.spacetime_handlers import AbstractGeoHandler, AbstractTimePointEvent
+from src.spacetime.spacetime_analytics import SpaceTimePointStatistics
+from src.spacetime.spacetime_kde import kde_grid, linear_binning
+
+
+class Points(AbstractGeoHandler, AbstractTimePointEvent, SpaceTimePointStatistics):
+    t_field = "time"
+
+
+@pytest.fixture
+def points():
+    """600 points around Houston, over two days"""
+    rng = np.random.default_rng(0)
+    lon = -95.4 + rng.normal(0, 0.1, 600)
+    lat = 29.8 + rng.normal(0, 0.1, 600)
+    time = pd.Timestamp("2017-08-27") + pd.to_timedelta(rng.random(600) * 2 * 86400, unit="s")
+    return Points(gpd.GeoDataFrame({"time": time}, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326"))
+
+
+def integrate(axes, values):
+    return values.sum() * np.prod([a[1] - a[0] for a in axes])
+
+
+@pytest.mark.parametrize("kernel", ["gaussian", "tophat"])
+def test_kde_grid_integrates_to_one(kernel):
+    rng = np.random.default_rng(1)
+    axes, density = kde_grid(rng.normal(size=(500, 2)), bandwidth=0.3, grid_size=128, kernel=kernel)
+    assert integrate(axes, density) == pytest.approx(1, rel=0.01)
+
+
+def test_kde_grid_normalizes_by_the_points_binned():
+    rng = np.random.default_rng(2)
+    data = rng.uniform(0, 10, size=(1000, 1))
+    axes, density = kde_grid(data, bandwidth=0.05, grid_min=0, grid_max=5, grid_size=1001)
+    assert integrate(axes, density) == pytest.approx(1, rel=0.02)
+    binned = linear_binning(data, [0], [5], [1001]).sum()
+    _, kernel_sum = kde_grid(data, bandwidth=0.05, grid_min=0, grid_max=5, grid_size=1001, normalize=False)
+    assert integrate(axes, kernel_sum) == pytest.approx(binned, rel=0.02)
+
+
+def test_intensity_surface_integrates_to_the_points(points):
+    axes, intensity = points.intensity_surface(cell_size=500, bandwidth=5000)
+    assert integrate(axes, intensity) == pytest.approx(len(points.gdf), rel=1e-3)
+
+
+def test_space_time_intensity_surface_integrates_to_the_points(points):
+    axes, intensity = points.intensity_surface(cell_size=1000, time_step=1800)
+    assert len(axes) == 3
+    assert integrate(axes, intensity) == pytest.approx(len(points.gdf), rel=1e-3)
+
+
+def test_intensity_surface_within_extent(points):
+    # Only the points inside the extent's (projected) bounds, about the western half, are counted
+    extent = AbstractGeoHandler(gdf=gpd.GeoDataFrame(geometry=[box(-96, 29, -95.4, 30.6)], crs="EPSG:4326"))
+    axes, intensity = points.intensity_surface(cell_size=500, bandwidth=500, extent=extent)
+    xy = points.get_space_time_arrays()[0]
+    inside = ((xy >= [a[0] for a in axes]) & (xy <= [a[-1] for a in axes])).all(axis=1).sum()
+    assert 200 < inside < 400
+    assert integrate(axes, intensity) == pytest.approx(inside, rel=0.05)
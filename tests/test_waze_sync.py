@@ -0,0 +1,120 @@
+import re
+import threading
+from datetime import datetime
+import pytest
+from src.waze import FIRST_SHEET_ROW, WazeColumnStore, WazeHandler, sync_waze_to_local
+
+
+class FakeSheetsService:
+    """
+    Stands in for a Google Sheets service: spreadsheets().values().batchGet(...).execute()
+    answers from in-memory URL and time columns, starting at FIRST_SHEET_ROW, and records the ranges requested.
+    """
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId, ranges):
+        with self._lock:
+            self.requests.append((spreadsheetId, list(ranges)))
+        columns = self.sheets[spreadsheetId]
+        value_ranges = []
+        for column, r in zip(columns, ranges):
+            start = int(re.search(r"![A-Z]+(\d+):", r).group(1))
+            rows = column[start - FIRST_SHEET_ROW:]
+            value_ranges.append({"range": r, "values": [[i] for i in rows]} if rows else {"range": r})
+        return FakeRequest({"spreadsheetId": spreadsheetId, "valueRanges": value_ranges})
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+def waze_url(lat, lon):
+    return "https://www.waze.com/ul?ll&lat={}&lon={}&zoom=17".format(lat, lon)
+
+
+REGISTRY = [{"event": "Harvey", "spreadsheet_id": "harvey"}, {"event": "Plains Flooding", "spreadsheet_id": "plains"}]
+
+
+@pytest.fixture
+def sheets():
+    return {
+        "harvey": ([waze_url(29.76, -95.37), waze_url(29.70, -95.40), "not a url"],
+                   ["8/27/2017 10:15:00", "8/27/17 11:30", "8/27/2017 12:00:00"]),
+        "plains": ([waze_url(38.5, -98.1)], ["5/2/2019 08:00:00"]),
+    }
+
+
+def test_sync_twice(sheets, tmp_path):
+    root = str(tmp_path / "waze")
+    service = FakeSheetsService(sheets)
+    assert sync_waze_to_local(root, registry=REGISTRY, service_factory=lambda: service) == \
+        {"Harvey": 3, "Plains Flooding": 1}
+
+    store = WazeColumnStore(root)
+    harvey = store.read("Harvey")
+    # The row without a URL is fetched, but not stored
+    assert list(harvey.lat) == [29.76, 29.70]
+    assert list(harvey.time) == [20170827101500, 20170827113000]
+    assert store.get_last_row("Harvey") == FIRST_SHEET_ROW + 2
+
+    # New rows on one sheet; the second sync only requests the rows after the last one synced
+    urls, times = sheets["harvey"]
+    urls.append(waze_url(29.80, -95.30))
+    times.append("8/28/2017 09:00:00")
+    service.requests.clear()
+    assert sync_waze_to_local(root, registry=REGISTRY, service_factory=lambda: service) == \
+        {"Harvey": 1, "Plains Flooding": 0}
+    requested = dict(service.requests)
+    assert requested["harvey"] == ["FormResponses!Q9:Q", "FormResponses!T9:T"]
+    assert requested["plains"] == ["FormResponses!Q7:Q", "FormResponses!T7:T"]
+
+    harvey = store.read("Harvey")
+    assert list(harvey.lat) == [29.76, 29.70, 29.80]
+    assert list(harvey.time)[-1] == 20170828090000
+    assert store.get_last_row("Harvey") == FIRST_SHEET_ROW + 3
+    assert len(store.read("Plains Flooding")) == 1
+
+
+def test_rows_with_blank_times_are_retried(tmp_path):
+    root = str(tmp_path / "waze")
+    # The last two rows are still being filled in: one has an empty time, and one no time cell at all
+    sheets = {"harvey": ([waze_url(29.76, -95.37), waze_url(29.70, -95.40), waze_url(29.80, -95.30)],
+                         ["8/27/2017 10:15:00", ""])}
+    service = FakeSheetsService(sheets)
+    registry = REGISTRY[:1]
+    assert sync_waze_to_local(root, registry=registry, service_factory=lambda: service) == {"Harvey": 1}
+    store = WazeColumnStore(root)
+    assert store.get_last_row("Harvey") == FIRST_SHEET_ROW
+
+    urls, times = sheets["harvey"]
+    times[1] = "8/27/2017 11:30:00"
+    times.append("8/28/2017 09:00:00")
+    service.requests.clear()
+    assert sync_waze_to_local(root, registry=registry, service_factory=lambda: service) == {"Harvey": 2}
+    assert service.requests == [("harvey", ["FormResponses!Q7:Q", "FormResponses!T7:T"])]
+    assert list(store.read("Harvey").time) == [20170827101500, 20170827113000, 20170828090000]
+    assert store.get_last_row("Harvey") == FIRST_SHEET_ROW + 2
+
+
+def test_waze_handler_reads_the_store(sheets, tmp_path):
+    root = str(tmp_path / "waze")
+    sync_waze_to_local(root, registry=REGISTRY, service_factory=lambda: FakeSheetsService(sheets))
+    waze = WazeHandler("Harvey", store=WazeColumnStore(root))
+    waze.prep_data()
+    assert len(waze.gdf) == 2
+    assert list(waze.gdf.time) == [datetime(2017, 8, 27, 10, 15), datetime(2017, 8, 27, 11, 30)]
+    assert list(waze.gdf.geometry.y) == [29.76, 29.70]